@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+Response cache for anonymous resource API list and search requests.
+
+Responses are keyed on the normalised query string, the negotiated
+language, the anonymous permission generation and the versions of the tags the endpoint depends
+on. Saving or deleting a resource bumps the tag of its resource type (and
+the ``base`` tag), so only the affected endpoints are invalidated; any
+permission change granted to or revoked from anonymous users bumps the
+anonymous permission generation.
+"""
+
+import hashlib
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import signals
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import translation
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from .counts import normalize_query
+
+logger = logging.getLogger(__name__)
+
+API_CACHE_TIMEOUT = getattr(settings, 'API_CACHE_TIMEOUT', 300)
+
+CACHED_PATHS = re.compile(
+    r'^/api/(?:(?P<list>base|videos)|(?P<search>[^/]+)/search)/?$')
+
+BASE_TAG = 'base'
+PERMISSIONS_TAG = 'anonymous-permissions'
+
+TAG_PREFIX = 'ama_hub:api:tag:'
+RESPONSE_PREFIX = 'ama_hub:api:response:'
+
+# the request headers a cached response depends on; Cookie selects the
+# session language and tells authenticated requests apart
+VARY_HEADERS = ('Accept', 'Accept-Language', 'Cookie')
+
+
+def _new_version():
+    # a timestamp rather than 1, so a tag evicted from the cache can never
+    # come back with a version already used by a stored response
+    return int(time.time() * 1000)
+
+
+def tag_versions(tags):
+    """
+    Returns the current version of each tag in ``tags``, in order.
+    """
+    keys = [TAG_PREFIX + tag for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _new_version(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def invalidate_tags(*tags):
+    """
+    Bumps the version of every tag in ``tags``, orphaning the cached
+    responses depending on them.
+    """
+    for tag in tags:
+        key = TAG_PREFIX + tag
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), None)
+
+
+def path_tags(path):
+    """
+    Returns the tags the response for ``path`` depends on, or None when
+    ``path`` is not cached.
+    """
+    match = CACHED_PATHS.match(path)
+    if match is None:
+        return None
+    resource_name = match.group('list') or match.group('search')
+    if resource_name == BASE_TAG:
+        return [BASE_TAG]
+    return [resource_name.rstrip('s')]
+
+
+def resource_tags(instance):
+    """
+    Returns the tags a change to the resource ``instance`` invalidates.
+    """
+    if instance.polymorphic_ctype_id:
+        resource_type = ContentType.objects.get_for_id(
+            instance.polymorphic_ctype_id).model
+    else:
+        resource_type = instance._meta.model_name
+    return [BASE_TAG, resource_type]
+
+
+def is_cacheable(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if request.user.is_authenticated():
+        return False
+    if 'HTTP_AUTHORIZATION' in request.META:
+        return False
+    return 'api_key' not in request.GET and 'access_token' not in request.GET
+
+
+def response_cache_key(request, tags):
+    versions = tag_versions([PERMISSIONS_TAG] + tags)
+    signature = '%s?%s|%s|%s|%s' % (
+        request.path,
+        normalize_query(request.GET, ignore=('_',)),
+        request.META.get('HTTP_ACCEPT', ''),
+        translation.get_language(),
+        ':'.join(str(v) for v in versions))
+    return RESPONSE_PREFIX + hashlib.md5(signature).hexdigest()
+
+
+def etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return etag in [e.strip() for e in if_none_match.split(',')]
+
+
+class ApiCacheMiddleware(MiddlewareMixin):
+
+    """
+    Serves anonymous API list and search requests from the cache and
+    answers conditional requests with 304 Not Modified.
+    """
+
+    def process_request(self, request):
+        if not API_CACHE_TIMEOUT:
+            return None
+        tags = path_tags(request.path)
+        if tags is None or not is_cacheable(request):
+            return None
+
+        request._api_cache_key = response_cache_key(request, tags)
+        entry = cache.get(request._api_cache_key)
+        if entry is None:
+            return None
+
+        request._api_cache_hit = True
+        if etag_matches(request, entry['etag']):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(
+                entry['content'], content_type=entry['content_type'])
+        response['ETag'] = entry['etag']
+        patch_vary_headers(response, VARY_HEADERS)
+        return response
+
+    def process_response(self, request, response):
+        key = getattr(request, '_api_cache_key', None)
+        if key is None or getattr(request, '_api_cache_hit', False):
+            return response
+        if response.status_code != 200 or response.streaming:
+            return response
+
+        etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+        cache.set(key, {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'etag': etag,
+        }, API_CACHE_TIMEOUT)
+
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+        response['ETag'] = etag
+        patch_vary_headers(response, VARY_HEADERS)
+        return response
+
+
+def resource_changed(sender, instance, **kwargs):
+    from geonode.base.models import ResourceBase
+
+    if isinstance(instance, ResourceBase):
+        invalidate_tags(*resource_tags(instance))
+
+
+def is_anonymous_permission(instance):
+    """
+    Returns whether the guardian object permission ``instance`` is held by
+    the anonymous user or group; True when that cannot be resolved.
+    """
+    from guardian.utils import get_anonymous_user
+
+    try:
+        if getattr(instance, 'user_id', None) is not None:
+            return instance.user_id == get_anonymous_user().pk
+        return instance.group.name == 'anonymous'
+    except BaseException:
+        logger.exception('Could not resolve the owner of %s', instance)
+        return True
+
+
+def object_permission_changed(sender, instance, **kwargs):
+    if is_anonymous_permission(instance):
+        invalidate_tags(PERMISSIONS_TAG)
+
+
+def connect_invalidation_signals():
+    from guardian.models import UserObjectPermission, GroupObjectPermission
+
+    for signal in (signals.post_save, signals.post_delete,
+                   signals.m2m_changed):
+        signal.connect(resource_changed,
+                       dispatch_uid='ama_hub.api_cache.resource_changed')
+    for model in (UserObjectPermission, GroupObjectPermission):
+        for signal in (signals.post_save, signals.post_delete):
+            signal.connect(
+                object_permission_changed,
+                sender=model,
+                dispatch_uid='ama_hub.api_cache.permission_changed')
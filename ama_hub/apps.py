@@ -26,6 +26,13 @@ def run_setup_hooks(*args, **kwargs):
     if celeryapp not in settings.INSTALLED_APPS:
         settings.INSTALLED_APPS += (celeryapp, )
 
+    from .api_cache import connect_invalidation_signals
+    from .fulltext import connect_fulltext_signals
+    from .keywords import connect_keyword_signals
+    connect_invalidation_signals()
+    connect_fulltext_signals()
+    connect_keyword_signals()
+
 
 class AppConfig(BaseAppConfig):
 
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""
+Counting helpers for the resource API.
+
+Facets and hit counts are computed in a single backend round trip and
+memoised for a short time per normalised query string. Very large ORM
+result sets can be given an estimated count taken from the query planner
+instead of an exact ``COUNT(*)``.
+"""
+
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.utils.http import urlencode
+
+logger = logging.getLogger(__name__)
+
+COUNT_CACHE_TIMEOUT = getattr(settings, 'API_COUNT_CACHE_TIMEOUT', 60)
+
+# result sets the planner expects to be larger than this are not counted
+# exactly; 0 disables estimation
+ESTIMATED_COUNT_THRESHOLD = getattr(
+    settings, 'API_ESTIMATED_COUNT_THRESHOLD', 0)
+
+# query parameters selecting a slice of the result set rather than the set
+PAGING_PARAMETERS = (
+    'limit', 'offset', 'order_by', 'fields', 'format', 'stream', 'callback',
+    '_')
+
+
+def normalize_query(params, ignore=PAGING_PARAMETERS):
+    """
+    Returns a canonical query string for ``params``: keys and values are
+    sorted, empty values and the ``ignore``d parameters are dropped.
+    """
+    items = []
+    for key in sorted(params.keys()):
+        if key in ignore:
+            continue
+        values = sorted(v for v in params.getlist(key) if v)
+        if values:
+            items.append((key, values))
+    return urlencode(items, doseq=True)
+
+
+def user_cache_key(user):
+    """
+    Returns the part of a cache key identifying whose permissions filtered
+    the cached result.
+    """
+    if user is None or not user.is_authenticated():
+        return 'anonymous'
+    return 'user:%s' % user.pk
+
+
+def count_tags(name):
+    """
+    Returns the response cache tags the counts of the API resource
+    ``name`` (e.g. ``layers`` or ``layers:search``) depend on.
+    """
+    from .api_cache import BASE_TAG, PERMISSIONS_TAG
+
+    resource_name = name.split(':')[0]
+    if resource_name == BASE_TAG:
+        return [PERMISSIONS_TAG, BASE_TAG]
+    return [PERMISSIONS_TAG, resource_name.rstrip('s')]
+
+
+def count_cache_key(name, request):
+    """
+    Returns the counts cache key for the resource ``name`` and the query
+    and user of ``request``.
+
+    The key includes the versions of the resource's cache tags, so saving
+    or deleting a resource of that type orphans its cached counts.
+    """
+    from .api_cache import tag_versions
+
+    signature = '%s|%s|%s|%s' % (
+        name, user_cache_key(request.user), normalize_query(request.GET),
+        ':'.join(str(v) for v in tag_versions(count_tags(name))))
+    return 'ama_hub:counts:%s' % hashlib.md5(signature).hexdigest()
+
+
+def search_counts(sqs, key=None):
+    """
+    Returns ``(facets, total_count)`` for a faceted SearchQuerySet.
+
+    Both values come from the same backend query, which is limited to a
+    single hit since only the counts are used.
+    """
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    clone = sqs.all()
+    clone.query.set_limits(0, 1)
+    facet_counts = clone.query.get_facet_counts() or {}
+
+    facets = {}
+    for facet, items in facet_counts.get('fields', {}).items():
+        facets[facet] = dict((item[0], item[1]) for item in items)
+    result = (facets, clone.query.get_count())
+
+    if key:
+        cache.set(key, result, COUNT_CACHE_TIMEOUT)
+    return result
+
+
+def planner_estimate(queryset):
+    """
+    Returns the number of rows the database planner expects ``queryset``
+    to return, or None where no estimate is available.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+    except DatabaseError:
+        logger.exception('Could not estimate the size of %s', queryset.model)
+        return None
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def queryset_count(queryset, key=None):
+    """
+    Returns ``(count, estimated)`` for ``queryset``.
+
+    The exact count is only computed when the planner estimate is below
+    ``API_ESTIMATED_COUNT_THRESHOLD``; otherwise the estimate is returned
+    and ``estimated`` is True.
+    """
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    result = None
+    if ESTIMATED_COUNT_THRESHOLD:
+        estimate = planner_estimate(queryset)
+        if estimate is not None and estimate > ESTIMATED_COUNT_THRESHOLD:
+            result = (estimate, True)
+    if result is None:
+        result = (queryset.count(), False)
+
+    if key:
+        cache.set(key, result, COUNT_CACHE_TIMEOUT)
+    return result
+
+
+class CountedPaginator(Paginator):
+
+    """
+    Django paginator over a result set whose size is already known, so
+    paginating does not issue another count query.
+    """
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self._known_count = count
+
+    @property
+    def count(self):
+        return self._known_count
@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+
+"""
+Facet counting for the browse and home pages.
+
+The filters shared by every resource type are applied once to a
+ResourceBase queryset, and the counts for all types and subtypes come from
+one ``GROUP BY polymorphic_ctype`` query. Unfiltered facets for anonymous
+users and superusers are read from precomputed counters instead. Results
+are cached per filter signature and user, and are invalidated with the API
+response cache tags.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, F, OuterRef, Sum
+
+from guardian.shortcuts import get_objects_for_user
+
+from geonode.base.models import ResourceBase
+from geonode.groups.models import GroupProfile
+from geonode.security.utils import get_visible_resources
+
+from .api_cache import (BASE_TAG, PERMISSIONS_TAG, is_anonymous_permission,
+                        tag_versions)
+from .counts import normalize_query, user_cache_key
+from .fulltext import search_resources
+from .keywords import keyword_subtree_ids
+from .spatial import filter_bbox
+
+FACETS_CACHE_TIMEOUT = getattr(settings, 'FACETS_CACHE_TIMEOUT', 60)
+
+# facet parameters read from the query string
+FACET_PARAMETERS = (
+    'q',
+    'title__icontains',
+    'extent',
+    'keywords__slug__in',
+    'category__identifier__in',
+    'regions__name__in',
+    'owner__username__in',
+    'date__gte',
+    'date__lte',
+    'date__range',
+)
+
+# columns the subtype of a resource is read from
+SUBTYPE_FIELDS = (
+    'layer__storeType',
+    'layer__has_time',
+    'video__video_type',
+    'document__doc_type',
+)
+
+# facet_type values counting the subtypes of a single resource type
+SUBTYPE_MODELS = {
+    'videos': 'video',
+    'documents': 'document',
+}
+
+
+def filter_resources(queryset, request):
+    """
+    Applies the facet filters of ``request`` and the visibility rules for
+    its user to ``queryset``.
+    """
+    params = request.GET
+    user = request.user if request else None
+
+    title_filter = params.get('q', '') or params.get('title__icontains', '')
+    if title_filter:
+        queryset = search_resources(queryset, title_filter)
+
+    category_filter = params.getlist('category__identifier__in')
+    if category_filter:
+        queryset = queryset.filter(category__identifier__in=category_filter)
+
+    regions_filter = params.getlist('regions__name__in')
+    if regions_filter:
+        queryset = queryset.filter(regions__name__in=regions_filter)
+
+    owner_filter = params.getlist('owner__username__in')
+    if owner_filter:
+        queryset = queryset.filter(owner__username__in=owner_filter)
+
+    if params.get('date__gte'):
+        queryset = queryset.filter(date__gte=params.get('date__gte'))
+    if params.get('date__lte'):
+        queryset = queryset.filter(date__lte=params.get('date__lte'))
+    if params.get('date__range'):
+        queryset = queryset.filter(
+            date__range=params.get('date__range').split(','))
+
+    queryset = get_visible_resources(
+        queryset,
+        user,
+        admin_approval_required=settings.ADMIN_MODERATE_UPLOADS,
+        unpublished_not_visible=settings.RESOURCE_PUBLISHING,
+        private_groups_not_visibile=settings.GROUP_PRIVATE_RESOURCES)
+
+    if params.get('extent'):
+        queryset = filter_bbox(queryset, params.get('extent'))
+
+    keywords_filter = params.getlist('keywords__slug__in')
+    if keywords_filter:
+        queryset = queryset.filter(
+            keywords__in=keyword_subtree_ids(keywords_filter))
+
+    if not settings.SKIP_PERMS_FILTER:
+        authorized = get_objects_for_user(
+            user, 'base.view_resourcebase').values('id')
+        queryset = queryset.filter(id__in=authorized)
+
+    return queryset
+
+
+def subtype_key(row):
+    """
+    Returns the subtype of a resource from its ``layer__storeType``,
+    ``layer__has_time``, ``video__video_type`` and ``document__doc_type``.
+    """
+    store_type = row.get('layer__storeType')
+    if store_type:
+        if store_type == 'dataStore' and row.get('layer__has_time'):
+            return 'vectorTimeSeries'
+        return store_type
+    return row.get('video__video_type') or row.get('document__doc_type') or ''
+
+
+def count_types(queryset):
+    """
+    Returns the number of resources of ``queryset`` per ``(resource type,
+    subtype)`` from one grouped query.
+    """
+    counts = queryset.values(
+        'polymorphic_ctype_id', *SUBTYPE_FIELDS).annotate(
+        count=Count('id', distinct=True)).order_by()
+
+    subtype_counts = {}
+    for row in counts:
+        model = ContentType.objects.get_for_id(row['polymorphic_ctype_id']).model
+        key = (model, subtype_key(row))
+        subtype_counts[key] = subtype_counts.get(key, 0) + row['count']
+    return subtype_counts
+
+
+def assemble_facets(facet_type, subtype_counts):
+    """
+    Returns the facets of ``facet_type`` from per ``(resource type,
+    subtype)`` counts.
+    """
+    if facet_type in SUBTYPE_MODELS:
+        model_name = SUBTYPE_MODELS[facet_type]
+        return dict((subtype, count)
+                    for (model, subtype), count in subtype_counts.items()
+                    if model == model_name)
+
+    store_types = {}
+    type_counts = {}
+    for (model, subtype), count in subtype_counts.items():
+        type_counts[model] = type_counts.get(model, 0) + count
+        if model == 'layer':
+            store_types[subtype] = store_types.get(subtype, 0) + count
+
+    vector_time = store_types.get('vectorTimeSeries', 0)
+    facets = {
+        'raster': store_types.get('coverageStore', 0),
+        'vector': store_types.get('dataStore', 0) + vector_time,
+        'vector_time': vector_time,
+        'remote': store_types.get('remoteStore', 0),
+        'wms': store_types.get('wmsStore', 0),
+    }
+
+    # Break early if only_layers is set.
+    if facet_type == 'layers':
+        return facets
+
+    facets['map'] = type_counts.get('map', 0)
+    facets['document'] = type_counts.get('document', 0)
+    facets['video'] = type_counts.get('video', 0)
+
+    if facet_type == 'home':
+        facets['user'] = get_user_model().objects.exclude(
+            username='AnonymousUser').count()
+
+        facets['group'] = GroupProfile.objects.exclude(
+            access="private").count()
+
+        facets['layer'] = facets['raster'] + \
+            facets['vector'] + facets['remote'] + facets['wms']  # + facets['vector_time']
+
+    return facets
+
+
+def is_filtered(request):
+    return any(request.GET.get(key) for key in FACET_PARAMETERS)
+
+
+def compute_facets(request, facet_type):
+    counts = counter_subtype_counts(request)
+    if counts is None:
+        counts = count_types(
+            filter_resources(ResourceBase.objects.all(), request))
+    return assemble_facets(facet_type, counts)
+
+
+#
+# Precomputed counters
+#
+# FacetCounter rows hold the number of resources per (resource type,
+# subtype, visibility class): only unfiltered facets are read from them, so
+# they are not split further. They are updated by the resource save and
+# delete signals, and by the signals of the guardian permissions granting
+# anonymous users the view permission, connected in videos/models.py; the
+# reconcile_facet_counters task rebuilds them, also catching changes made
+# by queryset updates. Failed updates mark the counters stale until the
+# next reconcile; stale counters are not read.
+#
+# The columns deciding the counter of a resource are remembered when it is
+# loaded, so saving it only queries the database when one of them changed.
+#
+
+COUNTERS_STATE_KEY = 'ama_hub:facets:counters'
+COUNTERS_GENERATION_KEY = 'ama_hub:facets:counters:generation'
+RECONCILING_KEY = 'ama_hub:facets:counters:reconciling'
+
+# seconds after which an interrupted reconcile no longer counts as running
+RECONCILE_TIMEOUT = 3600
+
+PUBLIC = 'public'
+RESTRICTED = 'restricted'
+
+# the attributes of a resource deciding its counter, and the subtype
+# columns they are read as
+COUNTER_ATTRIBUTES = {
+    'is_published': None,
+    'is_approved': None,
+    'group_id': None,
+    'storeType': 'layer__storeType',
+    'has_time': 'layer__has_time',
+    'video_type': 'video__video_type',
+    'doc_type': 'document__doc_type',
+}
+
+
+def counters_generation():
+    """
+    Returns the generation of the counters, bumped whenever they are
+    marked stale.
+    """
+    generation = cache.get(COUNTERS_GENERATION_KEY)
+    if generation is None:
+        # a timestamp, so a generation evicted from the cache is not reused
+        cache.add(COUNTERS_GENERATION_KEY, int(time.time() * 1000), None)
+        generation = cache.get(COUNTERS_GENERATION_KEY)
+    return generation
+
+
+def counters_fresh():
+    # fresh when the last reconcile saw the current generation
+    state = cache.get_many([COUNTERS_STATE_KEY, COUNTERS_GENERATION_KEY])
+    return COUNTERS_STATE_KEY in state and \
+        state[COUNTERS_STATE_KEY] == state.get(COUNTERS_GENERATION_KEY)
+
+
+def mark_counters_stale():
+    try:
+        cache.incr(COUNTERS_GENERATION_KEY)
+    except ValueError:
+        cache.set(COUNTERS_GENERATION_KEY, int(time.time() * 1000), None)
+
+
+def counter_subtype_counts(request):
+    """
+    Returns the ``(resource type, subtype)`` counts of the precomputed
+    counters visible to the user of ``request``, or None when the counters
+    cannot answer the request: it is filtered, comes from an authenticated
+    non-superuser, or the counters are stale.
+    """
+    from .videos.models import FacetCounter
+
+    user = request.user
+    if is_filtered(request) or not counters_fresh():
+        return None
+    counters = FacetCounter.objects.all()
+    if not user.is_authenticated():
+        counters = counters.filter(visibility=PUBLIC)
+    elif not user.is_superuser:
+        return None
+
+    subtype_counts = {}
+    for row in counters.values('resource_type', 'subtype').annotate(
+            total=Sum('count')).order_by():
+        subtype_counts[(row['resource_type'], row['subtype'])] = row['total']
+    return subtype_counts
+
+
+def public_resources(queryset):
+    """
+    Limits ``queryset`` to the resources anonymous users can see.
+    """
+    from guardian.utils import get_anonymous_user
+
+    queryset = queryset.filter(id__in=get_objects_for_user(
+        get_anonymous_user(), 'base.view_resourcebase').values('id'))
+    if settings.RESOURCE_PUBLISHING:
+        queryset = queryset.filter(is_published=True)
+    if settings.ADMIN_MODERATE_UPLOADS:
+        queryset = queryset.filter(is_approved=True)
+    if settings.GROUP_PRIVATE_RESOURCES:
+        queryset = queryset.exclude(group__in=GroupProfile.objects.filter(
+            access='private').values('group'))
+    return queryset
+
+
+def counter_key(resource_type, subtype, is_public):
+    return {
+        'resource_type': resource_type,
+        'subtype': subtype or '',
+        'visibility': PUBLIC if is_public else RESTRICTED,
+    }
+
+
+def counter_snapshot(resource):
+    """
+    Returns the attributes of ``resource`` deciding its counter, or None
+    when one of them is deferred; reading it would cost a query.
+    """
+    snapshot = {}
+    for field in resource._meta.concrete_fields:
+        if field.attname in COUNTER_ATTRIBUTES:
+            if field.attname not in resource.__dict__:
+                return None
+            snapshot[field.attname] = resource.__dict__[field.attname]
+    return snapshot
+
+
+def snapshot_key(resource, snapshot, is_public):
+    row = dict((column, snapshot.get(attname))
+               for attname, column in COUNTER_ATTRIBUTES.items() if column)
+    return counter_key(
+        ContentType.objects.get_for_id(resource.polymorphic_ctype_id).model,
+        subtype_key(row), is_public)
+
+
+def anonymous_can_view(resource_id):
+    from guardian.utils import get_anonymous_user
+
+    return get_objects_for_user(
+        get_anonymous_user(), 'base.view_resourcebase').filter(
+        id=resource_id).exists()
+
+
+def snapshot_public(snapshot, can_view):
+    """
+    Returns whether a resource with the columns of ``snapshot`` is public,
+    ``can_view`` telling whether anonymous users hold its view permission.
+    """
+    if settings.RESOURCE_PUBLISHING and not snapshot.get('is_published'):
+        return False
+    if settings.ADMIN_MODERATE_UPLOADS and not snapshot.get('is_approved'):
+        return False
+    if settings.GROUP_PRIVATE_RESOURCES and snapshot.get('group_id') and \
+            GroupProfile.objects.filter(
+                group_id=snapshot['group_id'], access='private').exists():
+        return False
+    return can_view
+
+
+def stored_counter_key(resource_id):
+    """
+    Returns the counter key of the stored resource ``resource_id``, read
+    with one query, or None if it is not stored.
+    """
+    public = public_resources(ResourceBase.objects.filter(id=OuterRef('id')))
+    row = ResourceBase.objects.filter(id=resource_id).annotate(
+        is_public=Exists(public.values('id'))).values(
+        'polymorphic_ctype_id', 'is_public', *SUBTYPE_FIELDS).first()
+    if row is None:
+        return None
+    return counter_key(
+        ContentType.objects.get_for_id(row['polymorphic_ctype_id']).model,
+        subtype_key(row), row['is_public'])
+
+
+def add_to_counter(key, delta):
+    from .videos.models import FacetCounter
+
+    if cache.get(RECONCILING_KEY):
+        # the running reconcile may not see this change
+        mark_counters_stale()
+    updated = FacetCounter.objects.filter(**key).update(
+        count=F('count') + delta)
+    if not updated and delta > 0:
+        try:
+            with transaction.atomic():
+                FacetCounter.objects.create(count=delta, **key)
+        except IntegrityError:
+            FacetCounter.objects.filter(**key).update(
+                count=F('count') + delta)
+
+
+def move_counter(old_key, new_key):
+    if old_key != new_key:
+        if old_key:
+            add_to_counter(old_key, -1)
+        add_to_counter(new_key, 1)
+
+
+def resource_loaded(resource):
+    # also run for new instances, whose snapshot is ignored when created
+    resource._facet_counter_snapshot = counter_snapshot(resource)
+
+
+def resource_saving(resource):
+    """
+    Reads the counter key of the stored version of ``resource`` when it
+    was loaded with deferred counter columns.
+    """
+    resource._facet_counter_key = None
+    if resource.pk and getattr(
+            resource, '_facet_counter_snapshot', None) is None:
+        resource._facet_counter_key = stored_counter_key(resource.pk)
+
+
+def resource_saved(resource, created):
+    old = getattr(resource, '_facet_counter_snapshot', None)
+    new = counter_snapshot(resource)
+    resource._facet_counter_snapshot = new
+    if created:
+        # a new resource: no permission can have been granted on it yet
+        add_to_counter(snapshot_key(resource, new or {}, False), 1)
+    elif old is not None:
+        if old != new:
+            # saving changes the columns, not the permissions
+            can_view = anonymous_can_view(resource.pk)
+            move_counter(
+                snapshot_key(resource, old, snapshot_public(old, can_view)),
+                snapshot_key(resource, new, snapshot_public(new, can_view)))
+    else:
+        move_counter(getattr(resource, '_facet_counter_key', None),
+                     stored_counter_key(resource.pk))
+
+
+def resource_deleting(resource):
+    key = stored_counter_key(resource.pk)
+    if key:
+        add_to_counter(key, -1)
+
+
+def affects_visibility(permission):
+    """
+    Returns whether adding or removing the guardian object permission
+    ``permission`` can change the visibility class of a resource.
+    """
+    return permission.content_type_id == ContentType.objects.get_for_model(
+        ResourceBase).id and \
+        permission.permission_id == view_permission_id() and \
+        is_anonymous_permission(permission)
+
+
+_VIEW_PERMISSION_ID = []
+
+
+def view_permission_id():
+    from django.contrib.auth.models import Permission
+
+    if not _VIEW_PERMISSION_ID:
+        _VIEW_PERMISSION_ID.append(Permission.objects.get(
+            content_type=ContentType.objects.get_for_model(ResourceBase),
+            codename='view_resourcebase').id)
+    return _VIEW_PERMISSION_ID[0]
+
+
+def permission_changing(permission):
+    """
+    Remembers the counter key of the resource of ``permission`` before the
+    permission is granted or revoked.
+    """
+    if affects_visibility(permission):
+        permission._facet_counter_key = stored_counter_key(
+            permission.object_pk)
+
+
+def permission_changed(permission):
+    # removing the permissions of a deleted resource finds no stored row,
+    # and its count was already removed by resource_deleting
+    old_key = getattr(permission, '_facet_counter_key', None)
+    if old_key is None:
+        return
+    new_key = stored_counter_key(permission.object_pk)
+    if new_key:
+        move_counter(old_key, new_key)
+
+
+def reconcile_facet_counters():
+    """
+    Rebuilds every FacetCounter from the resources table. The counters are
+    marked fresh unless they were marked stale, or changed, meanwhile.
+    """
+    from .videos.models import FacetCounter
+
+    cache.set(RECONCILING_KEY, True, RECONCILE_TIMEOUT)
+    try:
+        generation = counters_generation()
+
+        public = public_resources(ResourceBase.objects.all())
+        classes = (
+            (True, public),
+            (False, ResourceBase.objects.exclude(id__in=public.values('id'))),
+        )
+        totals = {}
+        for is_public, queryset in classes:
+            counts = queryset.values(
+                'polymorphic_ctype_id', *SUBTYPE_FIELDS).annotate(
+                count=Count('id')).order_by()
+            for row in counts:
+                key = counter_key(
+                    ContentType.objects.get_for_id(
+                        row['polymorphic_ctype_id']).model,
+                    subtype_key(row), is_public)
+                key = tuple(sorted(key.items()))
+                totals[key] = totals.get(key, 0) + row['count']
+
+        with transaction.atomic():
+            FacetCounter.objects.all().delete()
+            FacetCounter.objects.bulk_create([
+                FacetCounter(count=count, **dict(key))
+                for key, count in totals.items()])
+
+        if counters_generation() == generation:
+            cache.set(COUNTERS_STATE_KEY, generation, None)
+    finally:
+        cache.delete(RECONCILING_KEY)
+
+
+def facets_cache_key(request, facet_type):
+    versions = tag_versions([PERMISSIONS_TAG, BASE_TAG])
+    signature = '%s|%s|%s|%s' % (
+        facet_type,
+        user_cache_key(request.user),
+        normalize_query(request.GET, ignore=[
+            key for key in request.GET.keys()
+            if key not in FACET_PARAMETERS]),
+        ':'.join(str(v) for v in versions))
+    return 'ama_hub:facets:%s' % hashlib.md5(signature).hexdigest()
+
+
+def resource_facets(request, facet_type='all'):
+    """
+    Returns the facet counts of ``facet_type`` for the filters and user of
+    ``request``.
+    """
+    key = facets_cache_key(request, facet_type)
+    facets = cache.get(key)
+    if facets is None:
+        facets = compute_facets(request, facet_type)
+        cache.set(key, facets, FACETS_CACHE_TIMEOUT)
+    return facets
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+PostgreSQL full-text search over resources, used when HAYSTACK_SEARCH is
+disabled.
+
+Each resource has a ``tsvector`` kept in ResourceSearchDocument (GIN
+indexed by the ``videos`` migration 0007) weighting its titles, keywords
+and abstracts, in every translated language, in that order. The document
+is rebuilt in SQL from the resource row once the transaction changing the
+resource, its keywords or the name of one of its keywords commits. Other
+databases fall back to ``title__icontains``.
+
+The documents are only maintained while full-text search is enabled; run
+the ``rebuild_search_documents`` command after enabling it again.
+"""
+
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import F, signals
+
+logger = logging.getLogger(__name__)
+
+FULLTEXT_SEARCH_CONFIG = getattr(settings, 'FULLTEXT_SEARCH_CONFIG', 'simple')
+
+# (weight, translated ResourceBase fields)
+WEIGHTED_FIELDS = (
+    ('A', 'title'),
+    ('C', 'abstract'),
+)
+KEYWORDS_WEIGHT = 'B'
+
+
+def fulltext_enabled(using='default'):
+    return (getattr(settings, 'FULLTEXT_SEARCH', True) and
+            not settings.HAYSTACK_SEARCH and
+            connections[using].vendor == 'postgresql')
+
+
+def field_columns(name):
+    """
+    Returns the columns of ResourceBase holding ``name`` and its
+    translations.
+    """
+    from django.core.exceptions import FieldDoesNotExist
+    from geonode.base.models import ResourceBase
+
+    names = [name]
+    try:
+        from modeltranslation.settings import AVAILABLE_LANGUAGES
+        from modeltranslation.utils import build_localized_fieldname
+        names.extend(build_localized_fieldname(name, lang)
+                     for lang in AVAILABLE_LANGUAGES)
+    except ImportError:
+        pass
+
+    columns = []
+    for field_name in names:
+        try:
+            column = ResourceBase._meta.get_field(field_name).column
+        except FieldDoesNotExist:
+            continue
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+
+def search_document_sql():
+    """
+    Returns the statement upserting the search documents of the resources
+    whose id is in the array parameter ``ids``.
+    """
+    from geonode.base.models import HierarchicalKeyword, ResourceBase
+    from ama_hub.videos.models import ResourceSearchDocument
+
+    connection = connections['default']
+    quote = connection.ops.quote_name
+    tagged = ResourceBase.keywords.through._meta
+
+    vectors = []
+    for weight, name in WEIGHTED_FIELDS:
+        text = 'concat_ws(\' \', %s)' % ', '.join(
+            'r.%s' % quote(column) for column in field_columns(name))
+        vectors.append(
+            "setweight(to_tsvector(%%(config)s::regconfig, %s), '%s')" % (
+                text, weight))
+    keywords = (
+        "coalesce((SELECT string_agg(k.name, ' ') FROM {tagged} t "
+        "JOIN {keyword} k ON k.id = t.{tag} "
+        "WHERE t.{resource} = r.id), '')").format(
+        tagged=quote(tagged.db_table),
+        keyword=quote(HierarchicalKeyword._meta.db_table),
+        tag=quote(tagged.get_field('tag').column),
+        resource=quote(tagged.get_field('content_object').column))
+    vectors.insert(1, "setweight(to_tsvector(%%(config)s::regconfig, %s), '%s')" % (
+        keywords, KEYWORDS_WEIGHT))
+
+    return (
+        'INSERT INTO {document} ({document_resource}, search_vector) '
+        'SELECT r.id, {vector} FROM {resource} r '
+        'WHERE r.id = ANY(%(ids)s) '
+        'ON CONFLICT ({document_resource}) '
+        'DO UPDATE SET search_vector = EXCLUDED.search_vector').format(
+        document=quote(ResourceSearchDocument._meta.db_table),
+        document_resource=quote(
+            ResourceSearchDocument._meta.get_field('resource').column),
+        vector=' || '.join(vectors),
+        resource=quote(ResourceBase._meta.db_table))
+
+
+def build_search_documents(ids):
+    """
+    Builds the search documents of the resources ``ids``, whether or not
+    full-text search is enabled. PostgreSQL only.
+    """
+    with connections['default'].cursor() as cursor:
+        cursor.execute(search_document_sql(), {
+            'config': FULLTEXT_SEARCH_CONFIG,
+            'ids': list(ids),
+        })
+
+
+def refresh_on_commit(ids):
+    """
+    Rebuilds the search documents of the resources ``ids`` once the current
+    transaction commits, so saving a resource does not wait for them.
+    """
+    ids = list(ids)
+    if not ids or not fulltext_enabled():
+        return
+
+    def refresh():
+        try:
+            build_search_documents(ids)
+        except DatabaseError:
+            logger.exception('Could not refresh search documents')
+
+    transaction.on_commit(refresh)
+
+
+def search_resources(queryset, text, rank=False):
+    """
+    Limits ``queryset``, of ResourceBase or any model inheriting from it,
+    to the resources matching ``text``, ordered by relevance if ``rank``.
+    """
+    from django.contrib.postgres.search import SearchQuery, SearchRank
+
+    text = text.replace('+', ' ').strip()
+    if not text:
+        return queryset
+    if not fulltext_enabled(queryset.db):
+        return queryset.filter(title__icontains=text)
+
+    query = SearchQuery(text, config=FULLTEXT_SEARCH_CONFIG)
+    queryset = queryset.filter(search_document__search_vector=query)
+    if rank:
+        queryset = queryset.order_by(SearchRank(
+            F('search_document__search_vector'), query).desc(), '-date')
+    return queryset
+
+
+def resource_changed(sender, instance, **kwargs):
+    from geonode.base.models import ResourceBase
+
+    if isinstance(instance, ResourceBase):
+        refresh_on_commit([instance.pk])
+
+
+def keywords_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # a keyword was added to or removed from resources
+        refresh_on_commit(pk_set or [])
+    else:
+        refresh_on_commit([instance.pk])
+
+
+def keyword_resources(keyword):
+    from geonode.base.models import ResourceBase
+
+    return list(ResourceBase.keywords.through.objects.filter(
+        tag=keyword).values_list('content_object_id', flat=True))
+
+
+def keyword_saved(sender, instance, created, **kwargs):
+    # the keyword may have been renamed
+    if not created and fulltext_enabled():
+        refresh_on_commit(keyword_resources(instance))
+
+
+def keyword_deleting(sender, instance, **kwargs):
+    # read before the tagged items are deleted with the keyword, refreshed
+    # once they are
+    if fulltext_enabled():
+        refresh_on_commit(keyword_resources(instance))
+
+
+def connect_fulltext_signals():
+    from geonode.base.models import HierarchicalKeyword, ResourceBase
+
+    signals.post_save.connect(
+        resource_changed, dispatch_uid='ama_hub.fulltext.resource_changed')
+    signals.m2m_changed.connect(
+        keywords_changed, sender=ResourceBase.keywords.through,
+        dispatch_uid='ama_hub.fulltext.keywords_changed')
+    signals.post_save.connect(
+        keyword_saved, sender=HierarchicalKeyword,
+        dispatch_uid='ama_hub.fulltext.keyword_saved')
+    signals.pre_delete.connect(
+        keyword_deleting, sender=HierarchicalKeyword,
+        dispatch_uid='ama_hub.fulltext.keyword_deleting')
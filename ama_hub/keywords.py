@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory index of the hierarchical keyword tree.
+
+Each keyword name and slug maps to the ids of the keyword and all its
+descendants, so filtering resources by keyword is a single
+``keywords__in=[ids]`` lookup instead of a union of ``get_tree`` querysets.
+The index is rebuilt, once per process, whenever a keyword is saved or
+deleted, and at the latest every ``KEYWORD_TREE_TIMEOUT`` seconds.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import signals
+
+KEYWORD_TREE_TIMEOUT = getattr(settings, 'KEYWORD_TREE_TIMEOUT', 300)
+
+VERSION_KEY = 'ama_hub:keywords:version'
+
+_tree = {
+    'version': None,
+    'built': 0,
+    'ids': {},
+}
+
+
+def _tree_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def build_keyword_tree():
+    """
+    Returns a dict mapping each lowercased keyword name and slug to the
+    sorted ids of the keywords in its subtree.
+    """
+    from geonode.base.models import HierarchicalKeyword
+
+    # materialized paths: a subtree is the run of nodes following its root
+    # in path order whose paths start with the root path
+    nodes = list(HierarchicalKeyword.objects.order_by('path').values_list(
+        'id', 'name', 'slug', 'path'))
+    subtrees = {}
+    for i, (pk, name, slug, path) in enumerate(nodes):
+        ids = [pk]
+        j = i + 1
+        while j < len(nodes) and nodes[j][3].startswith(path):
+            ids.append(nodes[j][0])
+            j += 1
+        for key in set([(name or '').lower(), (slug or '').lower()]):
+            if key:
+                subtrees.setdefault(key, set()).update(ids)
+    return dict((key, sorted(ids)) for key, ids in subtrees.items())
+
+
+def keyword_tree():
+    version = _tree_version()
+    if _tree['version'] != version or \
+            time.time() - _tree['built'] > KEYWORD_TREE_TIMEOUT:
+        _tree['ids'] = build_keyword_tree()
+        _tree['version'] = version
+        _tree['built'] = time.time()
+    return _tree['ids']
+
+
+def keyword_subtree_ids(keywords):
+    """
+    Returns the ids of the keywords named or slugged (case insensitively)
+    as any of ``keywords``, together with all their descendants.
+    """
+    tree = keyword_tree()
+    ids = set()
+    for keyword in keywords:
+        ids.update(tree.get(keyword.lower(), []))
+    return sorted(ids)
+
+
+def keywords_changed(sender, **kwargs):
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, int(time.time() * 1000), None)
+
+
+def connect_keyword_signals():
+    from geonode.base.models import HierarchicalKeyword
+
+    for signal in (signals.post_save, signals.post_delete):
+        signal.connect(keywords_changed, sender=HierarchicalKeyword,
+                       dispatch_uid='ama_hub.keywords.keywords_changed')
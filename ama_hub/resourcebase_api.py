@@ -1,17 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import json
+import operator
 import re
+from functools import reduce
 
 from django.core.urlresolvers import resolve
 from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.staticfiles.templatetags import staticfiles
 from tastypie.authentication import MultiAuthentication, SessionAuthentication
 from django.template.response import TemplateResponse
 from tastypie import http
 from tastypie.bundle import Bundle
+from tastypie.exceptions import BadRequest
 
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
 from tastypie.resources import ModelResource
@@ -21,10 +25,11 @@ from tastypie.utils import trailing_slash
 from guardian.shortcuts import get_objects_for_user
 
 from django.conf.urls import url
-from django.core.paginator import Paginator, InvalidPage
+from django.core.paginator import InvalidPage
 from django.http import Http404
 from django.core.exceptions import ObjectDoesNotExist
 from django.forms.models import model_to_dict
+from django.core.serializers.json import DjangoJSONEncoder
 
 from tastypie.utils.mime import build_content_type
 
@@ -39,6 +44,7 @@ from geonode.groups.models import GroupProfile
 from geonode.utils import check_ogc_backend
 from geonode.security.utils import get_visible_resources
 
+from geonode.api.paginator import CrossSiteXHRPaginator
 from geonode.api.api import (TagResource, 
 							 RegionResource,
                   			 OwnersResource,
@@ -47,6 +53,12 @@ from geonode.api.api import (TagResource,
                   			 GroupResource,
                    			 FILTER_TYPES)
 
+from .counts import (count_cache_key, search_counts, queryset_count,
+                     CountedPaginator)
+from .fulltext import search_resources
+from .keywords import keyword_subtree_ids
+from .search_query import build_search_queryset
+from .spatial import filter_bbox
 from .videos.models import Video
 
 if settings.HAYSTACK_SEARCH:
@@ -68,6 +80,90 @@ ADD_FILTER_TYPES = {
 
 FILTER_TYPES.update(ADD_FILTER_TYPES)
 
+# ?stream= formats writing list responses one object at a time
+STREAM_CONTENT_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+# objects read and formatted at a time by streamed responses
+STREAM_CHUNK_SIZE = 500
+
+# content type ids of each FILTER_TYPES model and its subclasses
+_POLYMORPHIC_CTYPE_IDS = {}
+
+
+def polymorphic_ctype_ids(model):
+    """
+    Returns the polymorphic content type ids of ``model`` and of every
+    model inheriting from it, as matched by ``instance_of(model)``.
+    """
+    if model not in _POLYMORPHIC_CTYPE_IDS:
+        models = [model]
+        for m in models:
+            models.extend(m.__subclasses__())
+        _POLYMORPHIC_CTYPE_IDS[model] = sorted(set(
+            ContentType.objects.get_for_model(
+                m, for_concrete_model=False).id
+            for m in models if not m._meta.abstract))
+    return _POLYMORPHIC_CTYPE_IDS[model]
+
+
+def type_filter(model, types):
+    """
+    Returns a single predicate on ``polymorphic_ctype_id`` and the layer
+    store type selecting the resources of ``types`` (FILTER_TYPES keys)
+    from a queryset of ``model``.
+    """
+    # Layer is reached from ResourceBase itself, or through the parent
+    # link from the other resource models
+    layer = 'layer__' if model is ResourceBase else 'resourcebase_ptr__layer__'
+
+    ctype_ids = set()
+    store_types = set()
+    time_store_types = set()
+    for the_type in types:
+        if the_type in LAYER_SUBTYPES.keys():
+            if 'vector_time' == the_type:
+                time_store_types.add(LAYER_SUBTYPES['vector'])
+            else:
+                store_types.add(LAYER_SUBTYPES[the_type])
+        else:
+            ctype_ids.update(polymorphic_ctype_ids(FILTER_TYPES[the_type]))
+
+    predicates = []
+    if ctype_ids:
+        predicates.append(Q(polymorphic_ctype_id__in=sorted(ctype_ids)))
+    layer_ctype_ids = polymorphic_ctype_ids(Layer)
+    if store_types:
+        predicates.append(Q(polymorphic_ctype_id__in=layer_ctype_ids) & Q(
+            **{layer + 'storeType__in': sorted(store_types)}))
+    if time_store_types:
+        predicates.append(Q(polymorphic_ctype_id__in=layer_ctype_ids) & Q(
+            **{layer + 'storeType__in': sorted(time_store_types),
+               layer + 'has_time': True}))
+    return reduce(operator.or_, predicates)
+
+
+class CountingPaginator(CrossSiteXHRPaginator):
+
+    """
+    Paginator reading total_count through the counting layer, so the count
+    is memoised and may be estimated for very large result sets.
+    """
+    count_key = None
+    count_estimated = False
+
+    def get_count(self):
+        count, self.count_estimated = queryset_count(
+            self.objects, key=self.count_key)
+        return count
+
+    def page(self):
+        output = super(CountingPaginator, self).page()
+        output['meta']['total_count_estimated'] = self.count_estimated
+        return output
+
 #
 # Modified CommonModelApi from geonode.api.resourcebase_api
 #
@@ -129,6 +225,44 @@ class ModCommonModelApi(ModelResource):
         'is_published',
         'dirty_state',
     ]
+    # keys added by format_object which may also be asked for with ?fields=
+    EXTRA_FIELDS = ['site_url', 'owner_name']
+    # computed keys and the VALUES they are derived from
+    FIELD_DEPENDENCIES = {
+        'owner_name': ['owner__username'],
+    }
+
+    def requested_fields(self, request):
+        """
+        Returns the fields asked for with ``?fields=a,b``, or None when
+        every field is wanted. ``id`` is always included.
+
+        Raises BadRequest for fields not in VALUES or EXTRA_FIELDS.
+        """
+        param = request.GET.get('fields')
+        if not param:
+            return None
+        requested = [f.strip() for f in param.split(',') if f.strip()]
+        allowed = set(self.VALUES) | set(self.EXTRA_FIELDS)
+        unknown = [f for f in requested if f not in allowed]
+        if unknown:
+            raise BadRequest(
+                "Unknown fields requested: %s" % ', '.join(unknown))
+        if 'id' not in requested:
+            requested.insert(0, 'id')
+        return requested
+
+    def selected_fields(self, requested):
+        """
+        Returns the requested fields together with the fields they are
+        computed from.
+        """
+        selected = list(requested)
+        for field in requested:
+            for dependency in self.FIELD_DEPENDENCIES.get(field, []):
+                if dependency not in selected:
+                    selected.append(dependency)
+        return selected
 
     def build_filters(self, filters=None, ignore_bad_filters=False, **kwargs):
         if filters is None:
@@ -140,6 +274,8 @@ class ModCommonModelApi(ModelResource):
             orm_filters.update({'type': filters.getlist('type__in')})
         if 'extent' in filters:
             orm_filters.update({'extent': filters['extent']})
+        if 'q' in filters and not settings.HAYSTACK_SEARCH:
+            orm_filters.update({'q': filters['q']})
         # Nothing returned if +'s are used instead of spaces for text search,
         # so swap them out. Must be a better way of doing this?
         for filter in orm_filters:
@@ -151,39 +287,21 @@ class ModCommonModelApi(ModelResource):
         types = applicable_filters.pop('type', None)
         extent = applicable_filters.pop('extent', None)
         keywords = applicable_filters.pop('keywords__slug__in', None)
+        text = None
+        if not settings.HAYSTACK_SEARCH:
+            # with haystack, text is searched by get_search and
+            # title__icontains stays a plain filter
+            text = applicable_filters.pop('q', None) or \
+                applicable_filters.pop('title__icontains', None)
+            applicable_filters.pop('title__icontains', None)
         semi_filtered = super(
             ModCommonModelApi,
             self).apply_filters(
             request,
             applicable_filters)
-        filtered = None
         if types:
-            for the_type in types:
-                if the_type in LAYER_SUBTYPES.keys():
-                    super_type = the_type
-                    if 'vector_time' == the_type:
-                        super_type = 'vector'
-                    if filtered:
-                        if 'time' in the_type:
-                            filtered = filtered | semi_filtered.filter(
-                                Layer___storeType=LAYER_SUBTYPES[super_type]).exclude(Layer___has_time=False)
-                        else:
-                            filtered = filtered | semi_filtered.filter(
-                                Layer___storeType=LAYER_SUBTYPES[super_type])
-                    else:
-                        if 'time' in the_type:
-                            filtered = semi_filtered.filter(
-                                Layer___storeType=LAYER_SUBTYPES[super_type]).exclude(Layer___has_time=False)
-                        else:
-                            filtered = semi_filtered.filter(
-                                Layer___storeType=LAYER_SUBTYPES[super_type])
-                else:
-                    if filtered:
-                        filtered = filtered | semi_filtered.instance_of(
-                            FILTER_TYPES[the_type])
-                    else:
-                        filtered = semi_filtered.instance_of(
-                            FILTER_TYPES[the_type])
+            filtered = semi_filtered.filter(
+                type_filter(semi_filtered.model, types))
         else:
             filtered = semi_filtered
 
@@ -199,6 +317,11 @@ class ModCommonModelApi(ModelResource):
         if keywords:
             filtered = self.filter_h_keywords(filtered, keywords)
 
+        if text:
+            filtered = search_resources(
+                filtered, text,
+                rank=not (request and request.GET.get('order_by')))
+
         return filtered
 
     def filter_published(self, queryset, request):
@@ -219,19 +342,7 @@ class ModCommonModelApi(ModelResource):
         return filter_set
 
     def filter_h_keywords(self, queryset, keywords):
-        filtered = queryset
-        treeqs = HierarchicalKeyword.objects.none()
-        for keyword in keywords:
-            try:
-                kws = HierarchicalKeyword.objects.filter(Q(name__iexact=keyword) | Q(slug__iexact=keyword))
-                for kw in kws:
-                    treeqs = treeqs | HierarchicalKeyword.get_tree(kw)
-            except ObjectDoesNotExist:
-                # Ignore keywords not actually used?
-                pass
-
-        filtered = queryset.filter(Q(keywords__in=treeqs))
-        return filtered
+        return queryset.filter(keywords__in=keyword_subtree_ids(keywords))
 
     def filter_bbox(self, queryset, bbox):
         """
@@ -242,236 +353,36 @@ class ModCommonModelApi(ModelResource):
         northeast_lng,northeast_lat'
         returns the modified query
         """
-        bbox = bbox.split(',')  # TODO: Why is this different when done through haystack?
-        bbox = map(str, bbox)  # 2.6 compat - float to decimal conversion
-        intersects = ~(Q(bbox_x0__gt=bbox[2]) | Q(bbox_x1__lt=bbox[0]) |
-                       Q(bbox_y0__gt=bbox[3]) | Q(bbox_y1__lt=bbox[1]))
-
-        return queryset.filter(intersects)
-
-    def build_haystack_filters(self, parameters):
-        from haystack.inputs import Raw
-        from haystack.query import SearchQuerySet, SQ  # noqa
-
-        sqs = None
-
-        # Retrieve Query Params
-
-        # Text search
-        query = parameters.get('q', None)
-
-        # Types and subtypes to filter (map, layer, vector, etc)
-        type_facets = parameters.getlist("type__in", [])
-
-        # If coming from explore page, add type filter from resource_name
-        resource_filter = self._meta.resource_name.rstrip("s")
-        if resource_filter != "base" and resource_filter not in type_facets:
-            type_facets.append(resource_filter)
-
-        # Publication date range (start,end)
-        date_end = parameters.get("date__lte", None)
-        date_start = parameters.get("date__gte", None)
-
-        # Topic category filter
-        category = parameters.getlist("category__identifier__in")
-
-        # Keyword filter
-        keywords = parameters.getlist("keywords__slug__in")
-
-        # Region filter
-        regions = parameters.getlist("regions__name__in")
-
-        # Owner filters
-        owner = parameters.getlist("owner__username__in")
-
-        # Sort order
-        sort = parameters.get("order_by", "relevance")
-
-        # Geospatial Elements
-        bbox = parameters.get("extent", None)
-
-        # Filter by Type and subtype
-        if type_facets is not None:
-            types = []
-            subtypes = []
-
-            for type in type_facets:
-                if type in RESOURCEBASE_TYPES:
-                    # Type is one of our Major Types (not a sub type)
-                    types.append(type)
-                elif type in LAYER_SUBTYPES.keys():
-                    subtypes.append(type)
-
-            if 'vector' in subtypes and 'vector_time' not in subtypes:
-                subtypes.append('vector_time')
-
-            if len(subtypes) > 0:
-                types.append("layer")
-                sqs = SearchQuerySet().narrow("subtype:%s" %
-                                              ','.join(map(str, subtypes)))
-
-            if len(types) > 0:
-                sqs = (SearchQuerySet() if sqs is None else sqs).narrow(
-                    "type:%s" % ','.join(map(str, types)))
-
-        # Filter by Query Params
-        # haystack bug? if boosted fields aren't included in the
-        # query, then the score won't be affected by the boost
-        if query:
-            if query.startswith('"') or query.startswith('\''):
-                # Match exact phrase
-                phrase = query.replace('"', '')
-                sqs = (SearchQuerySet() if sqs is None else sqs).filter(
-                    SQ(title__exact=phrase) |
-                    SQ(description__exact=phrase) |
-                    SQ(content__exact=phrase)
-                )
-            else:
-                words = [
-                    w for w in re.split(
-                        '\W',
-                        query,
-                        flags=re.UNICODE) if w]
-                for i, search_word in enumerate(words):
-                    if i == 0:
-                        sqs = (SearchQuerySet() if sqs is None else sqs) \
-                            .filter(
-                            SQ(title=Raw(search_word)) |
-                            SQ(description=Raw(search_word)) |
-                            SQ(content=Raw(search_word))
-                        )
-                    elif search_word in ["AND", "OR"]:
-                        pass
-                    elif words[i - 1] == "OR":  # previous word OR this word
-                        sqs = sqs.filter_or(
-                            SQ(title=Raw(search_word)) |
-                            SQ(description=Raw(search_word)) |
-                            SQ(content=Raw(search_word))
-                        )
-                    else:  # previous word AND this word
-                        sqs = sqs.filter(
-                            SQ(title=Raw(search_word)) |
-                            SQ(description=Raw(search_word)) |
-                            SQ(content=Raw(search_word))
-                        )
-
-        # filter by category
-        if category:
-            sqs = (SearchQuerySet() if sqs is None else sqs).narrow(
-                'category:%s' % ','.join(map(str, category)))
-
-        # filter by keyword: use filter_or with keywords_exact
-        # not using exact leads to fuzzy matching and too many results
-        # using narrow with exact leads to zero results if multiple keywords
-        # selected
-        if keywords:
-            for keyword in keywords:
-                sqs = (
-                    SearchQuerySet() if sqs is None else sqs).filter_or(
-                    keywords_exact=keyword)
-
-        # filter by regions: use filter_or with regions_exact
-        # not using exact leads to fuzzy matching and too many results
-        # using narrow with exact leads to zero results if multiple keywords
-        # selected
-        if regions:
-            for region in regions:
-                sqs = (
-                    SearchQuerySet() if sqs is None else sqs).filter_or(
-                    regions_exact__exact=region)
-
-        # filter by owner
-        if owner:
-            sqs = (
-                SearchQuerySet() if sqs is None else sqs).narrow(
-                    "owner__username:%s" % ','.join(map(str, owner)))
-
-        # filter by date
-        if date_start:
-            sqs = (SearchQuerySet() if sqs is None else sqs).filter(
-                SQ(date__gte=date_start)
-            )
-
-        if date_end:
-            sqs = (SearchQuerySet() if sqs is None else sqs).filter(
-                SQ(date__lte=date_end)
-            )
-
-        # Filter by geographic bounding box
-        if bbox:
-            left, bottom, right, top = bbox.split(',')
-            sqs = (
-                SearchQuerySet() if sqs is None else sqs).exclude(
-                SQ(
-                    bbox_top__lte=bottom) | SQ(
-                    bbox_bottom__gte=top) | SQ(
-                    bbox_left__gte=right) | SQ(
-                        bbox_right__lte=left))
-
-        # Apply sort
-        if sort.lower() == "-date":
-            sqs = (
-                SearchQuerySet() if sqs is None else sqs).order_by("-date")
-        elif sort.lower() == "date":
-            sqs = (
-                SearchQuerySet() if sqs is None else sqs).order_by("date")
-        elif sort.lower() == "title":
-            sqs = (SearchQuerySet() if sqs is None else sqs).order_by(
-                "title_sortable")
-        elif sort.lower() == "-title":
-            sqs = (SearchQuerySet() if sqs is None else sqs).order_by(
-                "-title_sortable")
-        elif sort.lower() == "-popular_count":
-            sqs = (SearchQuerySet() if sqs is None else sqs).order_by(
-                "-popular_count")
-        else:
-            sqs = (
-                SearchQuerySet() if sqs is None else sqs).order_by("-date")
+        return filter_bbox(queryset, bbox)
 
-        return sqs
+    def build_haystack_filters(self, parameters, user=None):
+        """
+        Returns the faceted SearchQuerySet for the search ``parameters``,
+        limited to the resources ``user`` may see.
+        """
+        return build_search_queryset(
+            parameters, self._meta.resource_name, user=user)
 
     def get_search(self, request, **kwargs):
         self.method_check(request, allowed=['get'])
         self.is_authenticated(request)
         self.throttle_check(request)
 
-        # Get the list of objects that matches the filter
-        sqs = self.build_haystack_filters(request.GET)
+        requested_fields = self.requested_fields(request)
 
-        if not settings.SKIP_PERMS_FILTER:
+        # Get the list of objects that matches the filter, faceted and
+        # limited to what the user may see
+        sqs = self.build_haystack_filters(request.GET, user=request.user)
 
-            filter_set = get_objects_for_user(
-                request.user, 'base.view_resourcebase')
-
-            filter_set = get_visible_resources(
-                filter_set,
-                request.user if request else None,
-                admin_approval_required=settings.ADMIN_MODERATE_UPLOADS,
-                unpublished_not_visible=settings.RESOURCE_PUBLISHING,
-                private_groups_not_visibile=settings.GROUP_PRIVATE_RESOURCES)
-
-            filter_set_ids = filter_set.values_list('id')
-            # Do the query using the filterset and the query term. Facet the
-            # results
-            if len(filter_set) > 0:
-                sqs = sqs.filter(id__in=filter_set_ids).facet('type').facet('subtype').facet(
-                    'owner') .facet('keywords').facet('regions').facet('category')
-            else:
-                sqs = None
-        else:
-            sqs = sqs.facet('type').facet('subtype').facet(
-                'owner').facet('keywords').facet('regions').facet('category')
-
-        if sqs:
-            # Build the Facet dict
-            facets = {}
-            for facet in sqs.facet_counts()['fields']:
-                facets[facet] = {}
-                for item in sqs.facet_counts()['fields'][facet]:
-                    facets[facet][item[0]] = item[1]
+        if sqs is not None:
+            # Facets and total count come from one backend query
+            facets, total_count = search_counts(
+                sqs, key=count_cache_key(
+                    '%s:search' % self._meta.resource_name, request))
 
             # Paginate the results
-            paginator = Paginator(sqs, request.GET.get('limit'))
+            paginator = CountedPaginator(
+                sqs, request.GET.get('limit'), total_count)
 
             try:
                 page = paginator.page(
@@ -488,7 +399,6 @@ class ModCommonModelApi(ModelResource):
                 next_page = page.next_page_number()
             else:
                 next_page = 1
-            total_count = sqs.count()
             objects = page.object_list
         else:
             next_page = 0
@@ -504,18 +414,21 @@ class ModCommonModelApi(ModelResource):
                 "offset": int(getattr(request.GET, 'offset', 0)),
                 "previous": previous_page,
                 "total_count": total_count,
+                "total_count_estimated": False,
                 "facets": facets,
             },
-            "objects": map(lambda x: self.get_haystack_api_fields(x), objects),
+            "objects": map(
+                lambda x: self.get_haystack_api_fields(x, requested_fields),
+                objects),
         }
 
         self.log_throttled_access(request)
         return self.create_response(request, object_list)
 
-    def get_haystack_api_fields(self, haystack_object):
+    def get_haystack_api_fields(self, haystack_object, fields=None):
         object_fields = dict(
             (k, v) for k, v in haystack_object.get_stored_fields().items() if not re.search(
-                '_exact$|_sortable$', k))
+                '_exact$|_sortable$', k) and (fields is None or k in fields))
         return object_fields
 
     def get_list(self, request, **kwargs):
@@ -527,8 +440,7 @@ class ModCommonModelApi(ModelResource):
 
         Should return a HttpResponse (200 OK).
         """
-        # TODO: Uncached for now. Invalidation that works for everyone may be
-        # impossible.
+        # Anonymous requests are cached by ama_hub.api_cache.ApiCacheMiddleware
         base_bundle = self.build_bundle(request=request)
         objects = self.obj_get_list(
             bundle=base_bundle,
@@ -542,6 +454,9 @@ class ModCommonModelApi(ModelResource):
             limit=self._meta.limit,
             max_limit=self._meta.max_limit,
             collection_name=self._meta.collection_name)
+        # only read by CountingPaginator
+        paginator.count_key = count_cache_key(
+            self._meta.resource_name, request)
         to_be_serialized = paginator.page()
 
         to_be_serialized = self.alter_list_data_to_serialize(
@@ -551,31 +466,50 @@ class ModCommonModelApi(ModelResource):
         return self.create_response(
             request, to_be_serialized, response_objects=objects)
 
-    def format_objects(self, objects):
+    def iter_objects(self, objects, fields=None):
         """
-        Format the objects for output in a response.
+        Returns an iterator over the rows of ``objects`` to be formatted,
+        reading them from the database in chunks. Only the columns needed
+        for ``fields`` are selected when it is given.
         """
         for key in ('site_url', 'has_time'):
             if key in self.VALUES:
                 idx = self.VALUES.index(key)
                 del self.VALUES[idx]
-        objects_json = objects.values(*self.VALUES)
+        values = self.VALUES
+        if fields is not None:
+            selected = self.selected_fields(fields)
+            values = [v for v in self.VALUES if v in selected]
+        return objects.values(*values).iterator()
 
+    def format_object(self, item, fields=None):
+        """
+        Format a single object for output in a response, keeping only
+        ``fields`` when it is given.
+        """
         # hack needed because dehydrate does not seem to work in CommonModelApi
-        for item in objects_json:
-            if 'site_url' not in item or len(item['site_url']) == 0:
-                item['site_url'] = settings.SITEURL
-            if item['thumbnail_url'] and len(item['thumbnail_url']) == 0:
-                item['thumbnail_url'] = staticfiles.static(settings.MISSING_THUMBNAIL)
-            if item['title'] and len(item['title']) == 0:
-                item['title'] = 'No title'
-            if 'owner__username' in item:
-                username = item['owner__username']
-                profiles = Profile.objects.filter(username=username)
-                if profiles:
-                    full_name = (profiles[0].get_full_name() or username)
-                    item['owner_name'] = full_name
-        return objects_json
+        if 'site_url' not in item or len(item['site_url']) == 0:
+            item['site_url'] = settings.SITEURL
+        if item.get('thumbnail_url') and len(item['thumbnail_url']) == 0:
+            item['thumbnail_url'] = staticfiles.static(settings.MISSING_THUMBNAIL)
+        if item.get('title') and len(item['title']) == 0:
+            item['title'] = 'No title'
+        if 'owner__username' in item:
+            username = item['owner__username']
+            profiles = Profile.objects.filter(username=username)
+            if profiles:
+                full_name = (profiles[0].get_full_name() or username)
+                item['owner_name'] = full_name
+        if fields is not None:
+            item = dict((k, v) for k, v in item.items() if k in fields)
+        return item
+
+    def format_objects(self, objects, fields=None):
+        """
+        Format the objects for output in a response.
+        """
+        return [self.format_object(item, fields)
+                for item in self.iter_objects(objects, fields)]
 
     def create_response(
             self,
@@ -590,6 +524,16 @@ class ModCommonModelApi(ModelResource):
         Mostly a useful shortcut/hook.
         """
 
+        stream_format = request.GET.get('stream')
+        if stream_format in STREAM_CONTENT_TYPES and isinstance(
+                data, dict) and 'objects' in data and not isinstance(
+                data['objects'], list):
+            return self.create_streaming_response(
+                request, data, stream_format,
+                filter_objects=response_objects is not None)
+
+        requested_fields = self.requested_fields(request)
+
         # If an user does not have at least view permissions, he won't be able
         # to see the resource at all.
         filtered_objects_ids = None
@@ -607,9 +551,11 @@ class ModCommonModelApi(ModelResource):
                 data['objects'] = [
                     x for x in list(
                         self.format_objects(
-                            data['objects'])) if x['id'] in filtered_objects_ids]
+                            data['objects'], requested_fields))
+                    if x['id'] in filtered_objects_ids]
             else:
-                data['objects'] = list(self.format_objects(data['objects']))
+                data['objects'] = list(
+                    self.format_objects(data['objects'], requested_fields))
 
             # give geonode version
             data['geonode_version'] = get_version()
@@ -622,6 +568,58 @@ class ModCommonModelApi(ModelResource):
             content_type=build_content_type(desired_format),
             **response_kwargs)
 
+    def create_streaming_response(
+            self, request, data, stream_format, filter_objects=True):
+        """
+        Returns a response writing the ``meta`` block first and then the
+        objects the user may see, read and formatted ``STREAM_CHUNK_SIZE``
+        at a time, either as a single JSON
+        document (``stream=json``) or one JSON document per line
+        (``stream=ndjson``).
+        """
+        objects = data.pop('objects')
+        data['geonode_version'] = get_version()
+        requested_fields = self.requested_fields(request)
+
+        # the visible ids of the page, in order, so only those are formatted
+        page_ids = list(objects.values_list('id', flat=True))
+        if filter_objects:
+            allowed_ids = set(get_objects_for_user(
+                request.user, 'base.view_resourcebase').filter(
+                id__in=page_ids).values_list('id', flat=True))
+            page_ids = [pk for pk in page_ids if pk in allowed_ids]
+        unsliced = objects.all()
+        unsliced.query.clear_limits()
+
+        def dumps(value):
+            return json.dumps(
+                self._meta.serializer.to_simple(value, {}),
+                cls=DjangoJSONEncoder)
+
+        def formatted():
+            # format_objects, as subclasses may post-process a whole batch
+            for start in range(0, len(page_ids), STREAM_CHUNK_SIZE):
+                chunk = unsliced.filter(
+                    id__in=page_ids[start:start + STREAM_CHUNK_SIZE])
+                for item in self.format_objects(chunk, requested_fields):
+                    yield dumps(item)
+
+        def ndjson():
+            yield dumps(data) + '\n'
+            for obj in formatted():
+                yield obj + '\n'
+
+        def document():
+            # the header is a complete JSON object, reopened for the list
+            yield dumps(data)[:-1] + ', "objects": ['
+            for i, obj in enumerate(formatted()):
+                yield obj if i == 0 else ', ' + obj
+            yield ']}'
+
+        return StreamingHttpResponse(
+            ndjson() if stream_format == 'ndjson' else document(),
+            content_type=STREAM_CONTENT_TYPES[stream_format])
+
     def prepend_urls(self):
         if settings.HAYSTACK_SEARCH:
             return [
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiles the resource API search parameters into a single haystack query.
+
+The filters are combined into one SQ tree and applied, with the narrow
+queries, sort order and facets, to a single SearchQuerySet, instead of
+cloning the queryset for every filter. Permissions are checked against
+the ``permission_principals`` field of the indexes of
+``ama_hub.videos.search_indexes``, so the query carries the principals of
+the user rather than the ids of every resource they can see.
+"""
+
+import re
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+
+PUBLIC_PRINCIPAL = 'public'
+
+FACET_FIELDS = ('type', 'subtype', 'owner', 'keywords', 'regions', 'category')
+
+SORT_FIELDS = {
+    '-date': '-date',
+    'date': 'date',
+    'title': 'title_sortable',
+    '-title': '-title_sortable',
+    '-popular_count': '-popular_count',
+}
+
+
+def _and(sq, other):
+    return other if sq is None else sq & other
+
+
+def _or(sq, other):
+    return other if sq is None else sq | other
+
+
+def user_principals(user):
+    """
+    Returns the principals whose documents ``user`` may see.
+    """
+    principals = [PUBLIC_PRINCIPAL]
+    if user is not None and user.is_authenticated():
+        principals.append('user:%s' % user.pk)
+        principals.extend(
+            'group:%s' % pk for pk in user.groups.values_list('id', flat=True))
+    return principals
+
+
+def resource_principals(resource):
+    """
+    Returns the principals allowed to view ``resource``: the public, users
+    and groups holding ``view_resourcebase`` on it, and its owner.
+
+    As in geonode.security.utils.get_visible_resources, unpublished or
+    unapproved resources and the resources of private groups are only
+    visible to their owner and to the members of their group, who still
+    need the view permission.
+    """
+    from django.contrib.auth import get_user_model
+    from django.db.models import Q
+    from guardian.models import UserObjectPermission, GroupObjectPermission
+    from guardian.utils import get_anonymous_user
+    from geonode.groups.models import GroupProfile
+
+    base = resource.get_self_resource()
+    ct = ContentType.objects.get_for_model(base)
+    filters = {
+        'content_type': ct,
+        'object_pk': str(base.pk),
+        'permission__codename': 'view_resourcebase',
+    }
+    anonymous_id = get_anonymous_user().pk
+    public = False
+    user_ids = set()
+    for user_id in UserObjectPermission.objects.filter(
+            **filters).values_list('user_id', flat=True):
+        if user_id == anonymous_id:
+            public = True
+        else:
+            user_ids.add(user_id)
+    group_ids = set()
+    for group_id, name in GroupObjectPermission.objects.filter(
+            **filters).values_list('group_id', 'group__name'):
+        if name == 'anonymous':
+            public = True
+        else:
+            group_ids.add(group_id)
+
+    principals = set()
+    if resource.owner_id:
+        principals.add('user:%s' % resource.owner_id)
+
+    restricted = (
+        (settings.RESOURCE_PUBLISHING and not resource.is_published) or
+        (settings.ADMIN_MODERATE_UPLOADS and not resource.is_approved) or
+        (settings.GROUP_PRIVATE_RESOURCES and resource.group_id and
+         GroupProfile.objects.filter(
+             group_id=resource.group_id, access='private').exists()))
+    if not restricted:
+        if public:
+            principals.add(PUBLIC_PRINCIPAL)
+        principals.update('user:%s' % pk for pk in user_ids)
+        principals.update('group:%s' % pk for pk in group_ids)
+    elif resource.group_id:
+        if public or resource.group_id in group_ids:
+            # every member of the group holds the permission
+            principals.add('group:%s' % resource.group_id)
+        elif user_ids or group_ids:
+            members = get_user_model().objects.filter(
+                groups=resource.group_id).filter(
+                Q(id__in=user_ids) | Q(groups__in=group_ids))
+            principals.update(
+                'user:%s' % pk
+                for pk in members.values_list('id', flat=True).distinct())
+    return sorted(principals)
+
+
+def compile_filters(parameters, resource_name):
+    """
+    Returns ``(sq, narrow_queries, sort_field)`` for the search
+    ``parameters`` of the API resource ``resource_name``.
+
+    The SQ tree combines the filters exactly as the chained ``filter`` /
+    ``filter_or`` / ``exclude`` calls it replaces did.
+    """
+    from haystack.inputs import Raw
+    from haystack.query import SQ
+
+    from .resourcebase_api import LAYER_SUBTYPES, RESOURCEBASE_TYPES
+
+    sq = None
+    narrow_queries = []
+
+    # Types and subtypes to filter (map, layer, vector, etc)
+    type_facets = parameters.getlist("type__in", [])
+
+    # If coming from explore page, add type filter from resource_name
+    resource_filter = resource_name.rstrip("s")
+    if resource_filter != "base" and resource_filter not in type_facets:
+        type_facets.append(resource_filter)
+
+    types = []
+    subtypes = []
+    for the_type in type_facets:
+        if the_type in RESOURCEBASE_TYPES:
+            # Type is one of our Major Types (not a sub type)
+            types.append(the_type)
+        elif the_type in LAYER_SUBTYPES.keys():
+            subtypes.append(the_type)
+
+    if 'vector' in subtypes and 'vector_time' not in subtypes:
+        subtypes.append('vector_time')
+
+    if subtypes:
+        types.append("layer")
+        narrow_queries.append("subtype:%s" % ','.join(map(str, subtypes)))
+    if types:
+        narrow_queries.append("type:%s" % ','.join(map(str, types)))
+
+    # haystack bug? if boosted fields aren't included in the
+    # query, then the score won't be affected by the boost
+    query = parameters.get('q', None)
+    if query:
+        if query.startswith('"') or query.startswith('\''):
+            # Match exact phrase
+            phrase = query.replace('"', '')
+            sq = _and(sq, SQ(title__exact=phrase) |
+                      SQ(description__exact=phrase) |
+                      SQ(content__exact=phrase))
+        else:
+            words = [w for w in re.split('\W', query, flags=re.UNICODE) if w]
+            for i, search_word in enumerate(words):
+                word_sq = (SQ(title=Raw(search_word)) |
+                           SQ(description=Raw(search_word)) |
+                           SQ(content=Raw(search_word)))
+                if i == 0:
+                    sq = _and(sq, word_sq)
+                elif search_word in ["AND", "OR"]:
+                    pass
+                elif words[i - 1] == "OR":  # previous word OR this word
+                    sq = _or(sq, word_sq)
+                else:  # previous word AND this word
+                    sq = _and(sq, word_sq)
+
+    category = parameters.getlist("category__identifier__in")
+    if category:
+        narrow_queries.append('category:%s' % ','.join(map(str, category)))
+
+    # not using exact leads to fuzzy matching and too many results
+    # using narrow with exact leads to zero results if multiple keywords
+    # selected
+    for keyword in parameters.getlist("keywords__slug__in"):
+        sq = _or(sq, SQ(keywords_exact=keyword))
+    for region in parameters.getlist("regions__name__in"):
+        sq = _or(sq, SQ(regions_exact__exact=region))
+
+    owner = parameters.getlist("owner__username__in")
+    if owner:
+        narrow_queries.append(
+            "owner__username:%s" % ','.join(map(str, owner)))
+
+    date_start = parameters.get("date__gte", None)
+    if date_start:
+        sq = _and(sq, SQ(date__gte=date_start))
+    date_end = parameters.get("date__lte", None)
+    if date_end:
+        sq = _and(sq, SQ(date__lte=date_end))
+
+    # Filter by geographic bounding box
+    bbox = parameters.get("extent", None)
+    if bbox:
+        left, bottom, right, top = bbox.split(',')
+        sq = _and(sq, ~(SQ(bbox_top__lte=bottom) | SQ(bbox_bottom__gte=top) |
+                        SQ(bbox_left__gte=right) | SQ(bbox_right__lte=left)))
+
+    sort = parameters.get("order_by", "relevance")
+    return sq, narrow_queries, SORT_FIELDS.get(sort.lower(), '-date')
+
+
+def permission_filter(user):
+    """
+    Returns the SQ limiting a search to the documents ``user`` may see, or
+    None when no constraint applies.
+    """
+    from haystack.query import SQ
+
+    if settings.SKIP_PERMS_FILTER or (user is not None and user.is_superuser):
+        return None
+    return SQ(permission_principals__in=user_principals(user))
+
+
+def build_search_queryset(parameters, resource_name, user=None,
+                          facets=FACET_FIELDS):
+    """
+    Returns the faceted SearchQuerySet for the search ``parameters`` of
+    the API resource ``resource_name``, as seen by ``user``.
+    """
+    from haystack.query import SearchQuerySet
+
+    sq, narrow_queries, sort_field = compile_filters(parameters, resource_name)
+    permission = permission_filter(user)
+    if permission is not None:
+        sq = _and(sq, permission)
+
+    # one queryset, whose query is built in place
+    sqs = SearchQuerySet()
+    query = sqs.query
+    for narrow_query in narrow_queries:
+        query.add_narrow_query(narrow_query)
+    if sq is not None:
+        query.add_filter(sq)
+    query.add_order_by(sort_field)
+    for field in facets:
+        query.add_field_facet(field)
+    return sqs
@@ -98,10 +98,11 @@ else re.split(r' *[,|:|;] *', os.getenv('ALLOWED_VIDEO_TYPES'))
 
 # MAX_VIDEO_SIZE = int(os.getenv('MAX_VIDEO_SIZE ', '2'))  # MB
 
-# VIDEO_TYPE_MAP and VIDEO_MIMETYPE_MAP update enumerations in
+# VIDEO_TYPE_MAP and VIDEO_MIMETYPE_MAP extend the enumerations in
 # videos/enumerations.py and should only
 # need to be uncommented if adding other types
-# to settings.ALLOWED_VIDEO_TYPES
+# to settings.ALLOWED_VIDEO_TYPES; they are read once, when the videos
+# app is ready (see videos/registry.py)
 
 # VIDEO_TYPE_MAP = {}
 # VIDEO_MIMETYPE_MAP = {}
@@ -112,9 +113,86 @@ else re.split(r' *[,|:|;] *', os.getenv('ALLOWED_VIDEO_TYPES'))
 
 RESOURCEBASE_TYPES = ["map", "layer", "document", "user", "video",]
 
+# seconds API total counts and facets are memoised per query
+API_COUNT_CACHE_TIMEOUT = int(os.getenv('API_COUNT_CACHE_TIMEOUT', '60'))
+
+# planner row estimate above which total_count is estimated rather than
+# counted exactly; 0 always counts exactly
+API_ESTIMATED_COUNT_THRESHOLD = int(
+    os.getenv('API_ESTIMATED_COUNT_THRESHOLD', '100000'))
+
+# seconds anonymous API list/search responses are cached; 0 disables
+API_CACHE_TIMEOUT = int(os.getenv('API_CACHE_TIMEOUT', '300'))
+
+MIDDLEWARE_CLASSES += ('ama_hub.api_cache.ApiCacheMiddleware',)
+
 #
 # Template Tag
 #
 
 RESOURCE_CONTEXT = ['layers', 'maps', 'documents', 'search', 'people',
-                    'groups', 'links', 'videos']
\ No newline at end of file
+                    'groups', 'links', 'videos']
+
+# seconds facet counts are cached per filter signature and user
+FACETS_CACHE_TIMEOUT = int(os.getenv('FACETS_CACHE_TIMEOUT', '60'))
+
+# seconds between rebuilds of the precomputed facet counters; counters are
+# not read after a permission change until they have been rebuilt
+FACET_COUNTERS_RECONCILE_INTERVAL = int(
+    os.getenv('FACET_COUNTERS_RECONCILE_INTERVAL', '600'))
+CELERY_BEAT_SCHEDULE['reconcile-facet-counters'] = {
+    'task': 'ama_hub.videos.tasks.reconcile_facet_counters',
+    'schedule': FACET_COUNTERS_RECONCILE_INTERVAL,
+    'options': {'queue': 'update'},
+}
+
+# whether video views are buffered in the cache, which must then be shared
+# by the web and celery processes; by default unless the cache is a dummy
+# or local memory one
+VIDEO_HITS_BUFFERED = ast.literal_eval(os.getenv('VIDEO_HITS_BUFFERED', 'None'))
+
+# seconds between flushes of the buffered video view counts
+VIDEO_HITS_FLUSH_INTERVAL = int(os.getenv('VIDEO_HITS_FLUSH_INTERVAL', '60'))
+CELERY_BEAT_SCHEDULE['flush-video-hits'] = {
+    'task': 'ama_hub.videos.tasks.flush_video_hits',
+    'schedule': VIDEO_HITS_FLUSH_INTERVAL,
+    'options': {'queue': 'update'},
+}
+
+# seconds the objects on a user's favorites page are cached; favoriting
+# or unfavoriting clears them
+FAVORITES_CACHE_TIMEOUT = int(os.getenv('FAVORITES_CACHE_TIMEOUT', '300'))
+
+# seconds the ids of the videos linked to a layer or map are cached; link
+# changes clear them
+RELATED_VIDEOS_CACHE_TIMEOUT = int(
+    os.getenv('RELATED_VIDEOS_CACHE_TIMEOUT', '3600'))
+
+# checkpoint of the reindex_resources command; keep it out of MEDIA_ROOT,
+# which is served publicly
+REINDEX_CHECKPOINT_FILE = os.getenv(
+    'REINDEX_CHECKPOINT_FILE',
+    os.path.join(os.path.dirname(LOCAL_ROOT), '.reindex_checkpoint.json'))
+
+# PostgreSQL full-text search of the resource API and facets when
+# HAYSTACK_SEARCH is disabled
+FULLTEXT_SEARCH = ast.literal_eval(os.getenv('FULLTEXT_SEARCH', 'True'))
+FULLTEXT_SEARCH_CONFIG = os.getenv('FULLTEXT_SEARCH_CONFIG', 'simple')
+
+# index video saves in bulk from a queue instead of on every save
+if HAYSTACK_SEARCH:
+    HAYSTACK_SIGNAL_PROCESSOR = 'ama_hub.videos.search_queue.QueuedSignalProcessor'
+    # replaced by the indexes of ama_hub.videos.search_indexes, which add
+    # the principals allowed to view each resource
+    for connection in HAYSTACK_CONNECTIONS.values():
+        connection.setdefault('EXCLUDED_INDEXES', []).extend([
+            'geonode.layers.search_indexes.LayerIndex',
+            'geonode.maps.search_indexes.MapIndex',
+            'geonode.documents.search_indexes.DocumentIndex',
+        ])
+    VIDEO_INDEX_FLUSH_INTERVAL = int(os.getenv('VIDEO_INDEX_FLUSH_INTERVAL', '5'))
+    CELERY_BEAT_SCHEDULE['flush-video-index-queue'] = {
+        'task': 'ama_hub.videos.tasks.flush_video_index_queue',
+        'schedule': VIDEO_INDEX_FLUSH_INTERVAL,
+        'options': {'queue': 'update', 'expires': VIDEO_INDEX_FLUSH_INTERVAL},
+    }
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bounding box filtering backed by a spatial index.
+
+On PostgreSQL the resource extents are compared as boxes, which the GiST
+expression index created by the ``videos`` migration 0003 serves for every
+resource type. Other databases fall back to range predicates on the four
+``bbox_*`` columns.
+
+Stored extents crossing the antimeridian (``bbox_x0 > bbox_x1``) are
+indexed shifted west by 360 degrees, as the box from ``bbox_x0 - 360`` to
+``bbox_x1``; each query box is then also compared shifted west, which
+matches the part of those extents east of ``bbox_x0``.
+"""
+
+import operator
+from functools import reduce
+
+from django.db import connections
+from django.db.models import BooleanField, F, FloatField, Func, Q, Value
+from django.db.models.functions import Cast
+
+# must match the expression of the base_resourcebase_extent_gist index
+EXTENT_BOX_SQL = (
+    'box(point(CASE WHEN {x0} > {x1} THEN {x0} - 360 ELSE {x0} END, {y0}), '
+    'point({x1}, {y1}))')
+
+
+class ExtentBox(Func):
+
+    """
+    The extent of a resource as the box indexed by the GiST index.
+    """
+
+    def __init__(self):
+        super(ExtentBox, self).__init__(*[
+            Cast(name, FloatField())
+            for name in ('bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1')])
+
+    def as_sql(self, compiler, connection):
+        columns = []
+        for expression in self.get_source_expressions():
+            sql, params = compiler.compile(expression)
+            # the columns are repeated in the SQL, so they must not have
+            # parameters
+            assert not params
+            columns.append(sql)
+        x0, y0, x1, y1 = columns
+        return EXTENT_BOX_SQL.format(x0=x0, y0=y0, x1=x1, y1=y1), []
+
+
+class Point(Func):
+    function = 'point'
+
+
+class Box(Func):
+    function = 'box'
+
+
+class Overlaps(Func):
+    template = '(%(expressions)s)'
+    arg_joiner = ' && '
+
+
+class AnyOf(Func):
+    template = '(%(expressions)s)'
+    arg_joiner = ' OR '
+
+
+def _box(x0, y0, x1, y1):
+    return Box(
+        Point(Value(x0, FloatField()), Value(y0, FloatField())),
+        Point(Value(x1, FloatField()), Value(y1, FloatField())))
+
+
+def parse_bbox(bbox):
+    """
+    Returns the boxes covered by the 'southwest_lng,southwest_lat,
+    northeast_lng,northeast_lat' string ``bbox`` as (x0, y0, x1, y1)
+    tuples of floats.
+
+    An extent crossing the antimeridian (x0 > x1) is split in two boxes,
+    one on each side of it.
+    """
+    x0, y0, x1, y1 = [float(v) for v in bbox.split(',')]
+    if x0 > x1:
+        return [(x0, y0, 180.0, y1), (-180.0, y0, x1, y1)]
+    return [(x0, y0, x1, y1)]
+
+
+def filter_bbox(queryset, bbox):
+    """
+    Limits ``queryset``, of ResourceBase or any model inheriting from it,
+    to the resources whose extent intersects ``bbox``.
+    """
+    boxes = parse_bbox(bbox)
+    connection = connections[queryset.db]
+
+    if connection.vendor == 'postgresql':
+        # each box, and the box shifted west for the crossing extents
+        overlaps = [
+            Overlaps(ExtentBox(), _box(x0 - shift, y0, x1 - shift, y1),
+                     output_field=BooleanField())
+            for x0, y0, x1, y1 in boxes for shift in (0, 360)]
+        # an annotation, so the ORM joins base_resourcebase when needed
+        name = '_bbox_overlap_%s' % len(queryset.query.annotations)
+        return queryset.annotate(**{
+            name: AnyOf(*overlaps, output_field=BooleanField())}).filter(
+            **{name: True})
+
+    intersects = reduce(operator.or_, [
+        ~(Q(bbox_y0__gt=y1) | Q(bbox_y1__lt=y0)) & (
+            (Q(bbox_x0__lte=F('bbox_x1')) &
+             ~(Q(bbox_x0__gt=x1) | Q(bbox_x1__lt=x0))) |
+            # crossing extents cover bbox_x0 to 180 and -180 to bbox_x1
+            (Q(bbox_x0__gt=F('bbox_x1')) &
+             (Q(bbox_x0__lte=x1) | Q(bbox_x1__gte=x0))))
+        for x0, y0, x1, y1 in boxes])
+    return queryset.filter(intersects)
@@ -4,7 +4,7 @@ from django.conf.urls import url, include
 from django.views.generic import TemplateView
 
 from geonode.urls import urlpatterns
-from .views import favorite
+from .views import favorite, favorite_list, favorite_states
 # get_favorites, delete_favorite,
 
 from geonode.api.urls import api
@@ -23,10 +23,19 @@ urlpatterns += [
         favorite, {'subject': 'video'},
         name='add_favorite_video'
     ),
+    url(
+        r'^favorite/states/?$',
+        favorite_states,
+        name='favorite_states'
+    ),
 ]
 
 urlpatterns = [
    url(r'^/?$',
        TemplateView.as_view(template_name='site_index.html'),
        name='home'),
+   # ahead of geonode's favorite list, which reads each favorite's object
+   url(r'^favorite/list/?$',
+       favorite_list,
+       name='favorite_list'),
  ] + urlpatterns
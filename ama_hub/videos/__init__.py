@@ -0,0 +1 @@
+default_app_config = "ama_hub.videos.apps.VideosConfig"
@@ -3,15 +3,15 @@
 from tastypie.authentication import MultiAuthentication, SessionAuthentication
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
 
-from ama_hub.resourcebase_api import ModCommonModelApi
+from ama_hub.resourcebase_api import ModCommonModelApi, CountingPaginator
 from geonode.api.resourcebase_api import CommonMetaApi
-from geonode.api.paginator import CrossSiteXHRPaginator
 from geonode.api.authorization import GeoNodeAuthorization, GeonodeApiKeyAuthentication
 
 from django.forms.models import model_to_dict
 
 from geonode.groups.models import GroupProfile
 from .models import Video
+from .popularity import pending_hits
 
 import settings
 
@@ -19,45 +19,100 @@ class VideoResource(ModCommonModelApi):
 
     """Video API"""
 
-    def format_objects(self, objects):
+    # has_time only applies to layers
+    VALUES = [v for v in ModCommonModelApi.VALUES if v != 'has_time']
+    EXTRA_FIELDS = ModCommonModelApi.EXTRA_FIELDS + [
+        'group_name',
+        'keywords',
+        'regions',
+        'store_type',
+        'online',
+    ]
+    FIELD_DEPENDENCIES = {
+        'owner_name': ['owner__username'],
+        'group_name': ['group__name'],
+    }
+    # model fields backing VALUES and EXTRA_FIELDS; None if not a column
+    FIELD_COLUMNS = {
+        'owner_name': 'owner',
+        'group_name': 'group',
+        'site_url': None,
+        'keywords': None,
+        'regions': None,
+        'store_type': None,
+        'online': None,
+    }
+
+    def iter_objects(self, objects, fields=None):
+        if fields is not None:
+            # polymorphic_ctype too, or the polymorphic iterator loads it
+            # again for every row
+            columns = set(['polymorphic_ctype'])
+            for field in self.selected_fields(fields):
+                column = self.FIELD_COLUMNS.get(field, field.split('__')[0])
+                if column:
+                    columns.add(column)
+            objects = objects.only(*columns)
+        return objects.iterator()
+
+    def format_objects(self, objects, fields=None):
+        formatted = super(VideoResource, self).format_objects(objects, fields)
+        # add the views not yet flushed to popular_count
+        counted = [item for item in formatted
+                   if 'popular_count' in item and 'id' in item]
+        pending = pending_hits(item['id'] for item in counted)
+        for item in counted:
+            item['popular_count'] = (item['popular_count'] or 0) + \
+                pending[item['id']]
+        return formatted
+
+    def format_object(self, obj, fields=None):
         """
-        Formats the objects and provides reference to list of layers in map
-        resources.
+        Formats a video and provides reference to its owner, category,
+        group, keywords and regions.
 
-        :param objects: Map objects
+        :param obj: Video object
+        :param fields: names of the fields to output, or None for all
         """
-        formatted_objects = []
-        for obj in objects:
-            # convert the object to a dict using the standard values.
-            formatted_obj = model_to_dict(obj, fields=self.VALUES)
+        def wanted(*names):
+            return fields is None or any(name in fields for name in names)
+
+        # convert the object to a dict using the standard values.
+        formatted_obj = model_to_dict(obj, fields=fields or self.VALUES)
+        if wanted('owner__username', 'owner_name'):
             username = obj.owner.get_username()
             full_name = (obj.owner.get_full_name() or username)
             formatted_obj['owner__username'] = username
             formatted_obj['owner_name'] = full_name
-            if obj.category:
-                formatted_obj['category__gn_description'] = obj.category.gn_description
-            if obj.group:
-                formatted_obj['group'] = obj.group
-                try:
-                    formatted_obj['group_name'] = GroupProfile.objects.get(slug=obj.group.name)
-                except GroupProfile.DoesNotExist:
-                    formatted_obj['group_name'] = obj.group
+        if wanted('category__gn_description') and obj.category:
+            formatted_obj['category__gn_description'] = obj.category.gn_description
+        if wanted('group__name', 'group_name') and obj.group:
+            formatted_obj['group'] = obj.group
+            formatted_obj['group__name'] = obj.group.name
+            try:
+                formatted_obj['group_name'] = GroupProfile.objects.get(slug=obj.group.name)
+            except GroupProfile.DoesNotExist:
+                formatted_obj['group_name'] = obj.group
 
+        if wanted('keywords'):
             formatted_obj['keywords'] = [k.name for k in obj.keywords.all()] if obj.keywords else []
+        if wanted('regions'):
             formatted_obj['regions'] = [r.name for r in obj.regions.all()] if obj.regions else []
 
-            if 'site_url' not in formatted_obj or len(formatted_obj['site_url']) == 0:
-                formatted_obj['site_url'] = settings.SITEURL
+        if 'site_url' not in formatted_obj or len(formatted_obj['site_url']) == 0:
+            formatted_obj['site_url'] = settings.SITEURL
 
-            # Probe Remote Services
-            formatted_obj['store_type'] = 'dataset'
-            formatted_obj['online'] = True
+        # Probe Remote Services
+        formatted_obj['store_type'] = 'dataset'
+        formatted_obj['online'] = True
 
-            formatted_objects.append(formatted_obj)
-        return formatted_objects
+        if fields is not None:
+            formatted_obj = dict(
+                (k, v) for k, v in formatted_obj.items() if k in fields)
+        return formatted_obj
 
     class Meta(CommonMetaApi):
-        paginator_class = CrossSiteXHRPaginator
+        paginator_class = CountingPaginator
         filtering = CommonMetaApi.filtering
         filtering.update({'video_type': ALL})
         queryset = Video.objects.distinct().order_by('-date')
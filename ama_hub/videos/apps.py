@@ -5,4 +5,11 @@ from django.apps import AppConfig
 
 
 class VideosConfig(AppConfig):
-    name = 'videos'
+    name = 'ama_hub.videos'
+    label = 'videos'
+
+    def ready(self):
+        from .registry import reload_video_registry
+        from .suggest import connect_suggest_signals
+        reload_video_registry()
+        connect_suggest_signals()
@@ -6,20 +6,25 @@ import re
 from autocomplete_light.registry import autodiscover
 
 from django import forms
+from django.db import transaction
 from django.utils.translation import ugettext as _
 from django.contrib.contenttypes.models import ContentType
-from django.conf import settings
 from django.forms import HiddenInput, TextInput
 from modeltranslation.forms import TranslationModelForm
 
+from .registry import video_registry
 from .models import (
     Video,
     VideoResourceLink,
+    clear_related_resources,
+    clear_related_video_ids,
     get_related_resources,
+    visible_resources,
 )
 from geonode.maps.models import Map
 from geonode.layers.models import Layer
 from geonode.documents.models import Document
+from geonode.base.models import ResourceBase
 # from ama_hub.links.models import External_Link
 
 autodiscover()  # flake8: noqa
@@ -27,62 +32,200 @@ autodiscover()  # flake8: noqa
 from geonode.base.forms import ResourceBaseForm
 
 
-class VideoFormMixin(object):
+LINK_VALUE = re.compile(r"type:(\d+)-id:(\d+)$")
+
+
+def link_resource_types():
+    """
+    Returns the ids of the content types videos can be linked to.
+    """
+    return [ContentType.objects.get_for_model(model).id
+            for model in (Layer, Map, Document)]
+
 
-    def generate_link_choices(self, resources=None):
+def link_choices(rows):
+    """
+    Returns ``[value, label]`` choices for ``rows`` of resource ``id``,
+    ``title`` and ``polymorphic_ctype_id``.
+    """
+    return [[
+        "type:%s-id:%s" % (row['polymorphic_ctype_id'], row['id']),
+        '%s (%s)' % (row['title'], ContentType.objects.get_for_id(
+            row['polymorphic_ctype_id']).model)
+    ] for row in rows]
+
+
+def search_link_choices(user, query='', page=1, page_size=25):
+    """
+    Returns ``(choices, more)`` for a page of the resources ``user`` can
+    see and link videos to whose title contains ``query``, ordered by
+    title.
+    """
+    rows = visible_resources(ResourceBase.objects.filter(
+        polymorphic_ctype_id__in=link_resource_types()), user)
+    if query:
+        rows = rows.filter(title__icontains=query)
+    start = (page - 1) * page_size
+    rows = list(rows.order_by('title', 'id').values(
+        'id', 'title', 'polymorphic_ctype_id')[start:start + page_size + 1])
+    return link_choices(rows[:page_size]), len(rows) > page_size
+
+
+def group_link_values(values):
+    """
+    Returns ``{content type id: [object ids]}`` for link ``values``.
+    """
+    grouped = {}
+    for value in values:
+        matches = LINK_VALUE.match(value)
+        if matches:
+            grouped.setdefault(int(matches.group(1)), []).append(
+                int(matches.group(2)))
+    return grouped
+
+
+class LinkChoicesWidget(forms.TextInput):
+
+    """
+    Comma separated link values, searched through the ``video_link_choices``
+    view by select2. The labels of the current values are rendered in
+    ``data-initial``.
+    """
 
-        if resources is None:
-            resources = list(Layer.objects.all())
-            resources += list(Map.objects.all())
-            resources += list(Document.objects.all())
-            # resources += list(External_Link.objects.all())
-            resources.sort(key=lambda x: x.title)
+    def format_value(self, value):
+        if isinstance(value, (list, tuple)):
+            return ','.join(value)
+        return value
 
-        choices = []
-        for obj in resources:
-            type_id = ContentType.objects.get_for_model(obj.__class__).id
-            choices.append([
-                "type:%s-id:%s" % (type_id, obj.id),
-                '%s (%s)' % (obj.title, obj.polymorphic_ctype.model)
-            ])
+    def get_context(self, name, value, attrs):
+        context = super(LinkChoicesWidget, self).get_context(name, value, attrs)
+        values = value if isinstance(value, (list, tuple)) else \
+            [v for v in (value or '').split(',') if v]
+        rows = []
+        for content_type_id, ids in group_link_values(values).items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            rows.extend(model.objects.filter(id__in=ids).values(
+                'id', 'title', 'polymorphic_ctype_id'))
+        context['widget']['attrs']['data-initial'] = json.dumps([
+            {'id': choice[0], 'text': choice[1]}
+            for choice in link_choices(rows)])
+        return context
 
-        return choices
 
-    def generate_link_values(self, resources=None):
-        choices = self.generate_link_choices(resources=resources)
+class LinkChoicesField(forms.Field):
+
+    """
+    Field for the resources linked to a video. Submitted values are only
+    checked against the database when the form is validated, with one
+    query per content type. When ``user`` is set, only the resources they
+    can see, and those already ``linked``, are accepted.
+    """
+
+    widget = LinkChoicesWidget
+    user = None
+    linked = ()
+
+    def to_python(self, value):
+        if not value:
+            return []
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return [v.strip() for v in value.split(',') if v.strip()]
+
+    def validate(self, value):
+        super(LinkChoicesField, self).validate(value)
+        invalid = [v for v in value if not LINK_VALUE.match(v)]
+        allowed_types = link_resource_types()
+        for content_type_id, ids in group_link_values(value).items():
+            prefix = 'type:%s-id:' % content_type_id
+            if content_type_id not in allowed_types:
+                invalid.extend(v for v in value if v.startswith(prefix))
+                continue
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            resources = model.objects.filter(id__in=ids)
+            if self.user is not None:
+                resources = visible_resources(resources, self.user)
+            found = set(resources.values_list('id', flat=True))
+            invalid.extend(
+                '%s%s' % (prefix, pk) for pk in ids
+                if pk not in found and '%s%s' % (prefix, pk) not in self.linked)
+        if invalid:
+            raise forms.ValidationError(
+                _("Select a valid choice. %s is not one of the available choices.")
+                % invalid[0])
+
+
+class VideoFormMixin(object):
+
+    def set_link_user(self, user, links_field='links'):
+        # a copy of the declared field is bound to each form instance
+        self.fields[links_field].user = user
+
+    def generate_link_choices(self, resources):
+        return link_choices([{
+            'id': obj.id,
+            'title': obj.title,
+            'polymorphic_ctype_id': obj.polymorphic_ctype_id,
+        } for obj in resources])
+
+    def generate_link_values(self, resources):
+        choices = self.generate_link_choices(resources)
         return [choice[0] for choice in choices]
 
     def save_many2many(self, links_field='links'):
-        # create and fetch desired links
-        instances = []
+        """
+        Makes the links of the video match the submitted values: missing
+        links are bulk created and the others deleted in one statement.
+        """
+        wanted = []
         for link in self.cleaned_data[links_field]:
-            matches = re.match("type:(\d+)-id:(\d+)", link)
+            matches = LINK_VALUE.match(link)
             if matches:
-                content_type = ContentType.objects.get(id=matches.group(1))
-                instance, _ = VideoResourceLink.objects.get_or_create(
-                    video=self.instance,
-                    content_type=content_type,
-                    object_id=matches.group(2),
-                )
-                instances.append(instance)
-
-        # delete remaining links
-        VideoResourceLink.objects\
-        .filter(video_id=self.instance.id).exclude(pk__in=[i.pk for i in instances]).delete()
+                key = (int(matches.group(1)), int(matches.group(2)))
+                if key not in wanted:
+                    wanted.append(key)
+
+        with transaction.atomic():
+            existing = dict(
+                ((content_type_id, object_id), pk)
+                for pk, content_type_id, object_id in
+                VideoResourceLink.objects.filter(
+                    video_id=self.instance.id).values_list(
+                    'pk', 'content_type_id', 'object_id'))
+            added = [key for key in wanted if key not in existing]
+            VideoResourceLink.objects.bulk_create([
+                VideoResourceLink(
+                    video_id=self.instance.id,
+                    content_type_id=content_type_id,
+                    object_id=object_id)
+                for content_type_id, object_id in added])
+            removed = dict(
+                (key, pk) for key, pk in existing.items() if key not in wanted)
+            if removed:
+                VideoResourceLink.objects.filter(
+                    pk__in=list(removed.values())).delete()
+        # once committed, so a concurrent lookup cannot cache the old ids;
+        # bulk_create sends no signals
+        clear_related_video_ids(added + list(removed))
+        clear_related_resources(self.instance)
 
 
 class VideoForm(ResourceBaseForm, VideoFormMixin):
 
-    links = forms.MultipleChoiceField(
+    links = LinkChoicesField(
         label=_("Link to another resource (optional)"),
         required=False)
 
     def __init__(self, *args, **kwargs):
+        user = kwargs.pop('user', None)
         super(VideoForm, self).__init__(*args, **kwargs)
-        self.fields['links'].choices = self.generate_link_choices()
         self.fields['links'].initial = self.generate_link_values(
             resources=get_related_resources(self.instance)
         )
+        # the current links stay valid, even to resources the user
+        # cannot see
+        self.fields['links'].linked = set(self.fields['links'].initial)
+        self.set_link_user(user)
 
     class Meta(ResourceBaseForm.Meta):
         model = Video
@@ -133,9 +276,8 @@ class VideoReplaceForm(forms.ModelForm):
         """
         video_file = self.cleaned_data.get('video_file')
 
-        if video_file and not os.path.splitext(
-                video_file.name)[1].lower()[
-                1:] in settings.ALLOWED_VIDEO_TYPES:
+        if video_file and not video_registry().is_allowed(
+                os.path.splitext(video_file.name)[1][1:]):
             raise forms.ValidationError(_("This file type is not allowed"))
 
         return video_file
@@ -153,10 +295,15 @@ class VideoCreateForm(TranslationModelForm, VideoFormMixin):
                 'id': 'permissions'}),
         required=True)
 
-    links = forms.MultipleChoiceField(
+    links = LinkChoicesField(
         label=_("Link to another resource (optional)"),
         required=False)
 
+    def __init__(self, *args, **kwargs):
+        user = kwargs.pop('user', None)
+        super(VideoCreateForm, self).__init__(*args, **kwargs)
+        self.set_link_user(user)
+
     class Meta:
         model = Video
         fields = ['title', 'video_file', 'video_url']
@@ -164,10 +311,6 @@ class VideoCreateForm(TranslationModelForm, VideoFormMixin):
             'name': HiddenInput(attrs={'cols': 80, 'rows': 20}),
         }
 
-    def __init__(self, *args, **kwargs):
-        super(VideoCreateForm, self).__init__(*args, **kwargs)
-        self.fields['links'].choices = self.generate_link_choices()
-
     def clean_permissions(self):
         """
         Ensures the JSON field is JSON.
@@ -203,9 +346,8 @@ class VideoCreateForm(TranslationModelForm, VideoFormMixin):
         """
         video_file = self.cleaned_data.get('video_file')
 
-        if video_file and not os.path.splitext(
-                video_file.name)[1].lower()[
-                1:] in settings.ALLOWED_VIDEO_TYPES:
+        if video_file and not video_registry().is_allowed(
+                os.path.splitext(video_file.name)[1][1:]):
             raise forms.ValidationError(_("This file type is not allowed"))
 
         return video_file
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from geonode.base.models import ResourceBase
+
+from ama_hub.fulltext import build_search_documents
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the full-text search documents of the resources. Run it "
+            "after enabling full-text search again, as the documents are not "
+            "maintained while it is disabled.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--missing', action='store_true', dest='missing', default=False,
+            help='Only build the documents of resources without one')
+        parser.add_argument(
+            '--batch-size', type=int, dest='batch_size', default=1000,
+            help='Resources rebuilt per statement (default: 1000)')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'postgresql':
+            raise CommandError('Full-text search requires PostgreSQL')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+
+        resources = ResourceBase.objects.order_by('id')
+        if options['missing']:
+            resources = resources.filter(search_document__isnull=True)
+        ids = list(resources.values_list('id', flat=True))
+        for start in range(0, len(ids), batch_size):
+            # one transaction per batch, so an interrupted run keeps its
+            # progress and can be resumed with --missing
+            with transaction.atomic():
+                build_search_documents(ids[start:start + batch_size])
+            if options['verbosity'] > 1:
+                self.stdout.write('%s/%s' % (
+                    min(start + batch_size, len(ids)), len(ids)))
+        if options['verbosity']:
+            self.stdout.write('Rebuilt %s search documents' % len(ids))
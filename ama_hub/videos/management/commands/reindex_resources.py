@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import json
+import multiprocessing
+import os
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from haystack import connections as haystack_connections
+from haystack.query import SearchQuerySet
+
+# outside MEDIA_ROOT, which is served publicly
+CHECKPOINT_FILE = getattr(
+    settings, 'REINDEX_CHECKPOINT_FILE',
+    os.path.join(os.path.dirname(settings.LOCAL_ROOT),
+                 '.reindex_checkpoint.json'))
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(path, checkpoint):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # write then rename, so a crash never leaves a truncated checkpoint
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(tmp_path, path)
+
+
+def index_version(index):
+    # bumped by indexes whose documents gained fields, see
+    # ama_hub.videos.search_indexes
+    return getattr(index, 'index_version', 0)
+
+
+def init_worker():
+    # connections inherited from the parent process must not be shared
+    connections.close_all()
+
+
+def remove_stale(model, using, start, end):
+    """
+    Removes the documents of ``model`` with an id in ``[start, end)`` whose
+    object no longer exists and returns how many were removed.
+    """
+    backend = haystack_connections[using].get_backend()
+    indexed = SearchQuerySet(using=using).models(model).filter(
+        id__gte=start, id__lt=end).values_list('id', flat=True)
+    # one request for the whole range, which holds at most end - start ids
+    indexed = set(int(pk) for pk in indexed[:end - start])
+    if not indexed:
+        return 0
+    existing = set(model._default_manager.filter(
+        pk__in=indexed).values_list('pk', flat=True))
+    stale = sorted(indexed - existing)
+    for pk in stale:
+        backend.remove('%s.%s' % (model._meta.label_lower, pk))
+    return len(stale)
+
+
+def index_chunk(args):
+    """
+    Indexes the objects of one chunk of primary keys, removes the documents
+    of deleted objects in that chunk and returns ``(label, chunk, indexed,
+    removed)``.
+    """
+    label, using, chunk, chunk_size, since = args
+    close_old_connections()
+    model = apps.get_model(label)
+    index = haystack_connections[using].get_unified_index().get_index(model)
+    start, end = chunk * chunk_size, (chunk + 1) * chunk_size
+    queryset = index.build_queryset(
+        using=using, start_date=parse_datetime(since) if since else None)
+    objects = list(queryset.filter(pk__gte=start, pk__lt=end))
+    if objects:
+        # the backend posts the whole chunk in one bulk request
+        haystack_connections[using].get_backend().update(index, objects)
+    return label, chunk, len(objects), remove_stale(model, using, start, end)
+
+
+class Command(BaseCommand):
+    help = ("Index resources in parallel chunks of primary keys. "
+            "Completed chunks are checkpointed so an interrupted run resumes "
+            "where it stopped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*',
+            help='Models to index as app_label.ModelName (default: all '
+                 'indexed models)')
+        parser.add_argument(
+            '--since', dest='since', default=None,
+            help="Only index objects changed since this ISO date, or 'last' "
+                 "for the start of the last completed run; indexes without "
+                 "an updated field are indexed in full")
+        parser.add_argument(
+            '--chunk-size', dest='chunk_size', type=int, default=500,
+            help='Primary keys per chunk (default: 500)')
+        parser.add_argument(
+            '--workers', dest='workers', type=int,
+            default=multiprocessing.cpu_count(),
+            help='Number of indexing processes (default: number of CPUs)')
+        parser.add_argument(
+            '--using', dest='using', default='default',
+            help='Search connection to index into')
+        parser.add_argument(
+            '--checkpoint', dest='checkpoint', default=CHECKPOINT_FILE,
+            help='Checkpoint file (default: %s)' % CHECKPOINT_FILE)
+        parser.add_argument(
+            '--restart', action='store_true', dest='restart', default=False,
+            help='Ignore the chunks completed by an interrupted run')
+
+    def handle(self, *args, **options):
+        using = options['using']
+        chunk_size = options['chunk_size']
+        checkpoint_path = options['checkpoint']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be positive.')
+
+        unified_index = haystack_connections[using].get_unified_index()
+        if options['labels']:
+            try:
+                models = [apps.get_model(label) for label in options['labels']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+        else:
+            models = unified_index.get_indexed_models()
+
+        checkpoint = read_checkpoint(checkpoint_path)
+        since = options['since']
+        if since == 'last':
+            since = checkpoint.get('last_run')
+        elif since and parse_datetime(since) is None:
+            raise CommandError("--since must be an ISO date or 'last'.")
+
+        # the documents of an index whose version changed since they were
+        # last indexed are stale, and reindexed in full even with --since
+        versions = checkpoint.get('versions', {})
+        model_since = {}
+        for model in models:
+            label = model._meta.label
+            if since and versions.get(label, 0) == index_version(
+                    unified_index.get_index(model)):
+                model_since[label] = since
+            else:
+                if since:
+                    self.stdout.write(
+                        '%s: index version changed, indexing all objects.' %
+                        label)
+                model_since[label] = None
+
+        # the changes to the objects of an index without an updated field
+        # cannot be told apart, so they are all indexed
+        for model in models:
+            label = model._meta.label
+            if model_since[label] and \
+                    not unified_index.get_index(model).get_updated_field():
+                self.stdout.write(
+                    '%s: index has no updated field, indexing all '
+                    'objects.' % label)
+                model_since[label] = None
+
+        run = checkpoint.get('run')
+        if options['restart'] or not run or run['since'] != since or \
+                run.get('models') != model_since or \
+                run['chunk_size'] != chunk_size:
+            run = {
+                'started': timezone.now().isoformat(),
+                'since': since,
+                'models': model_since,
+                'chunk_size': chunk_size,
+                'done': {},
+            }
+        else:
+            self.stdout.write('Resuming the run started at %s.' % run['started'])
+        checkpoint['run'] = run
+        write_checkpoint(checkpoint_path, checkpoint)
+
+        work = []
+        for model in models:
+            label = model._meta.label
+            index = unified_index.get_index(model)
+            start = model_since[label]
+            queryset = index.build_queryset(
+                using=using, start_date=parse_datetime(start) if start else None)
+            chunks = sorted(set(
+                pk // chunk_size
+                for pk in queryset.values_list('pk', flat=True).iterator()))
+            done = set(run['done'].get(label, []))
+            pending = [c for c in chunks if c not in done]
+            self.stdout.write('%s: %d chunks, %d already indexed.' % (
+                label, len(chunks), len(chunks) - len(pending)))
+            work.extend((label, using, chunk, chunk_size, start)
+                        for chunk in pending)
+
+        if options['workers'] > 1 and len(work) > 1:
+            connections.close_all()
+            pool = multiprocessing.Pool(options['workers'], init_worker)
+            results = pool.imap_unordered(index_chunk, work)
+        else:
+            pool = None
+            results = (index_chunk(args) for args in work)
+
+        started = time.time()
+        indexed = removed = 0
+        try:
+            for i, (label, chunk, count, stale) in enumerate(results, 1):
+                run['done'].setdefault(label, []).append(chunk)
+                write_checkpoint(checkpoint_path, checkpoint)
+                indexed += count
+                removed += stale
+                self.stdout.write(
+                    '[%d/%d] %s chunk %d: %d objects, %d removed (%.1f/s)' % (
+                        i, len(work), label, chunk, count, stale,
+                        indexed / max(time.time() - started, 0.001)))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        checkpoint['last_run'] = run['started']
+        for model in models:
+            versions[model._meta.label] = index_version(
+                unified_index.get_index(model))
+        checkpoint['versions'] = versions
+        checkpoint.pop('run')
+        write_checkpoint(checkpoint_path, checkpoint)
+        self.stdout.write('Indexed %d objects, removed %d deleted ones.' % (
+            indexed, removed))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+INDEX_NAME = 'base_resourcebase_extent_gist'
+
+# extents crossing the antimeridian are shifted west by 360 degrees, so
+# box() does not turn them into the opposite region; see ama_hub.spatial
+EXTENT_BOX_SQL = (
+    'box(point(CASE WHEN bbox_x0::float8 > bbox_x1::float8 '
+    'THEN bbox_x0::float8 - 360 ELSE bbox_x0::float8 END, bbox_y0::float8), '
+    'point(bbox_x1::float8, bbox_y1::float8))')
+
+
+def create_extent_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS {} ON base_resourcebase USING gist '
+        '(({}))'.format(INDEX_NAME, EXTENT_BOX_SQL))
+
+
+def drop_extent_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS {}'.format(INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0027_auto_20170801_1228_squashed_0037_auto_20190222_1347'),
+        ('videos', '0002_modfavorite'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_extent_index, drop_extent_index),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('videos', '0003_resourcebase_bbox_gist'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(max_length=64)),
+                ('subtype', models.CharField(blank=True, default='', max_length=128)),
+                ('visibility', models.CharField(max_length=16)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='facetcounter',
+            unique_together=set([('resource_type', 'subtype', 'visibility')]),
+        ),
+    ]
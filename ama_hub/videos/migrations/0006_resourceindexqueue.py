@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('videos', '0005_video_last_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResourceIndexQueue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_id', models.IntegerField(unique=True)),
+                ('queued', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
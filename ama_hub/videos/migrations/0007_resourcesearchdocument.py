@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+INDEX_NAME = 'videos_resourcesearchdocument_gin'
+
+# the weights of ama_hub.fulltext when this migration was written
+WEIGHTED_FIELDS = (
+    ('A', 'title'),
+    ('C', 'abstract'),
+)
+KEYWORDS_WEIGHT = 'B'
+
+
+def build_search_documents(apps, schema_editor):
+    """
+    Builds the documents of the existing resources from the historical
+    models, as ``ama_hub.fulltext`` did at this point.
+    """
+    from django.conf import settings
+
+    ResourceBase = apps.get_model('base', 'ResourceBase')
+    HierarchicalKeyword = apps.get_model('base', 'HierarchicalKeyword')
+    ResourceSearchDocument = apps.get_model('videos', 'ResourceSearchDocument')
+    quote = schema_editor.connection.ops.quote_name
+    tagged = ResourceBase._meta.get_field('keywords').remote_field.through._meta
+
+    def columns(name):
+        # the field and its translations, e.g. title and title_en
+        return [field.column for field in ResourceBase._meta.concrete_fields
+                if field.name == name or field.name.startswith(name + '_')]
+
+    vectors = [
+        "setweight(to_tsvector(%%(config)s::regconfig, concat_ws(' ', %s)), "
+        "'%s')" % (', '.join('r.%s' % quote(c) for c in columns(name)), weight)
+        for weight, name in WEIGHTED_FIELDS]
+    vectors.insert(1, (
+        "setweight(to_tsvector(%(config)s::regconfig, coalesce(("
+        "SELECT string_agg(k.name, ' ') FROM {tagged} t "
+        "JOIN {keyword} k ON k.id = t.{tag} "
+        "WHERE t.{resource} = r.id), '')), '{weight}')").format(
+        tagged=quote(tagged.db_table),
+        keyword=quote(HierarchicalKeyword._meta.db_table),
+        tag=quote(tagged.get_field('tag').column),
+        resource=quote(tagged.get_field('content_object').column),
+        weight=KEYWORDS_WEIGHT))
+
+    schema_editor.execute(
+        'INSERT INTO {document} ({document_resource}, search_vector) '
+        'SELECT r.id, {vector} FROM {resource} r '
+        'ON CONFLICT ({document_resource}) '
+        'DO UPDATE SET search_vector = EXCLUDED.search_vector'.format(
+            document=quote(ResourceSearchDocument._meta.db_table),
+            document_resource=quote(
+                ResourceSearchDocument._meta.get_field('resource').column),
+            vector=' || '.join(vectors),
+            resource=quote(ResourceBase._meta.db_table)),
+        {'config': getattr(settings, 'FULLTEXT_SEARCH_CONFIG', 'simple')})
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS {} ON videos_resourcesearchdocument '
+        'USING gin (search_vector)'.format(INDEX_NAME))
+    build_search_documents(apps, schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS {}'.format(INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0027_auto_20170801_1228_squashed_0037_auto_20190222_1347'),
+        ('videos', '0006_resourceindexqueue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResourceSearchDocument',
+            fields=[
+                ('resource', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='base.ResourceBase')),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(null=True)),
+            ],
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
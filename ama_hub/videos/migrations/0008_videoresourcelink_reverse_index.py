@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('videos', '0007_resourcesearchdocument'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='videoresourcelink',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Buffered view counts for videos.
+
+A page view increments a per-video counter in the cache instead of
+updating ``popular_count`` in the database. The flush_video_hits task
+moves the buffered counts to the database in batches: it adds each count
+to ``popular_count`` and then decrements the counter by the amount added,
+so views recorded during a flush are kept for the next one. A worker dying
+between the two counts that batch twice rather than losing it. Readers add
+the pending counts to the stored ``popular_count`` to get a near real-time
+value.
+
+The videos to flush are logged when their counter goes from 0 to 1, in
+numbered slots of the cache, so a flush reads the videos viewed since the
+previous one instead of every video id. A flush only reads the slots
+numbered by the flush before it, whose videos have been written by then.
+
+The cache must be shared by the web and celery processes (e.g. memcached
+or redis). With a per-process cache, unless ``VIDEO_HITS_BUFFERED`` says
+otherwise, and whenever the cache cannot hold a counter, views update the
+database directly.
+"""
+
+import logging
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, When
+
+logger = logging.getLogger(__name__)
+
+HITS_KEY = 'ama_hub:videos:hits:%s'
+# the video logged in each slot, the number of slots used, the slots read
+# by the last flush and the slots it found
+SLOT_KEY = 'ama_hub:videos:hits:slot:%s'
+SLOTS_KEY = 'ama_hub:videos:hits:slots'
+FLUSHED_KEY = 'ama_hub:videos:hits:flushed'
+READY_KEY = 'ama_hub:videos:hits:ready'
+FLUSH_LOCK_KEY = 'ama_hub:videos:hits:flushing'
+
+FLUSH_BATCH_SIZE = 1000
+FLUSH_LOCK_TIMEOUT = 600
+
+
+def hits_buffered():
+    buffered = getattr(settings, 'VIDEO_HITS_BUFFERED', None)
+    if buffered is None:
+        # a per-process cache would keep the counts from the flush task
+        return not isinstance(caches['default'], (DummyCache, LocMemCache))
+    return buffered
+
+
+def _incr(key, delta=1):
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # add is a no-op if another request created the key meanwhile
+        cache.add(key, 0, None)
+        return cache.incr(key, delta)
+
+
+def _log_video(video_id):
+    cache.set(SLOT_KEY % _incr(SLOTS_KEY), video_id, None)
+
+
+def _update_popular_count(counts):
+    from geonode.base.models import ResourceBase
+
+    with transaction.atomic():
+        ResourceBase.objects.filter(id__in=list(counts)).update(
+            popular_count=Case(
+                *[When(id=pk, then=F('popular_count') + count)
+                  for pk, count in counts.items()],
+                output_field=IntegerField()))
+
+
+def record_hit(video_id):
+    if hits_buffered():
+        try:
+            count = _incr(HITS_KEY % video_id)
+        except ValueError:
+            # the cache does not keep the counter
+            logger.warning('Could not buffer a view of video %s', video_id)
+        else:
+            if count == 1:
+                _log_video(video_id)
+            return
+    _update_popular_count({video_id: 1})
+
+
+def pending_hits(video_ids):
+    """
+    Returns ``{video id: views not yet flushed}`` for ``video_ids``.
+    """
+    video_ids = list(video_ids)
+    counts = cache.get_many([HITS_KEY % pk for pk in video_ids])
+    return dict((pk, counts.get(HITS_KEY % pk) or 0) for pk in video_ids)
+
+
+def _flush_batch(video_ids):
+    taken = dict((pk, count) for pk, count in
+                 pending_hits(video_ids).items() if count > 0)
+    if not taken:
+        return 0
+    _update_popular_count(taken)
+    for pk, count in taken.items():
+        # decrement rather than delete, keeping concurrent increments; the
+        # views recorded meanwhile did not log the video again
+        try:
+            if cache.decr(HITS_KEY % pk, count) > 0:
+                _log_video(pk)
+        except ValueError:
+            # the counter was evicted, with the views recorded meanwhile
+            pass
+    return sum(taken.values())
+
+
+def flush_video_hits(batch_size=FLUSH_BATCH_SIZE):
+    """
+    Adds the buffered views to ``popular_count`` and returns how many were
+    flushed.
+    """
+    if not cache.add(FLUSH_LOCK_KEY, True, FLUSH_LOCK_TIMEOUT):
+        # another flush is running
+        return 0
+    try:
+        slots = cache.get(SLOTS_KEY) or 0
+        flushed_to = cache.get(FLUSHED_KEY) or 0
+        ready = cache.get(READY_KEY) or 0
+        if ready > slots or flushed_to > ready:
+            # the cache lost the slot count
+            flushed_to = ready = 0
+
+        flushed = 0
+        for start in range(flushed_to + 1, ready + 1, batch_size):
+            keys = [SLOT_KEY % n
+                    for n in range(start, min(start + batch_size, ready + 1))]
+            flushed += _flush_batch(set(cache.get_many(keys).values()))
+            cache.set(FLUSHED_KEY, start + len(keys) - 1, None)
+            cache.delete_many(keys)
+        cache.set(FLUSHED_KEY, ready, None)
+        cache.set(READY_KEY, slots, None)
+        return flushed
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry of the video file types: the video type and mime type of each
+extension, its thumbnail placeholder and whether it may be uploaded.
+
+It is built once, when the app is ready, from ``enumerations`` and the
+``VIDEO_TYPE_MAP``, ``VIDEO_MIMETYPE_MAP`` and ``ALLOWED_VIDEO_TYPES``
+settings, and never modified afterwards; ``reload_video_registry`` builds
+it again, e.g. after overriding those settings in tests.
+"""
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+
+from .enumerations import VIDEO_TYPE_MAP, VIDEO_MIMETYPE_MAP
+
+PLACEHOLDER = 'videos/{0}-placeholder.png'
+
+DEFAULT_VIDEO_TYPE = 'other'
+DEFAULT_MIMETYPE = 'text/plain'
+
+_registry = None
+
+
+class VideoRegistry(object):
+
+    """
+    Read-only lookups by (case insensitive) file extension.
+    """
+
+    def __init__(self, types, mimetypes, allowed, placeholders,
+                 generic_placeholder):
+        self._types = dict(types)
+        self._mimetypes = dict(mimetypes)
+        self._allowed = frozenset(allowed)
+        self._placeholders = dict(placeholders)
+        self._generic_placeholder = generic_placeholder
+
+    def video_type(self, extension):
+        return self._types.get((extension or '').lower(), DEFAULT_VIDEO_TYPE)
+
+    def mimetype(self, extension):
+        return self._mimetypes.get((extension or '').lower(), DEFAULT_MIMETYPE)
+
+    def is_allowed(self, extension):
+        return (extension or '').lower() in self._allowed
+
+    def placeholder(self, extension):
+        """
+        Returns the path of the thumbnail placeholder for ``extension``, or
+        of the generic one, or None.
+        """
+        return self._placeholders.get((extension or '').lower()) or \
+            self._generic_placeholder
+
+    @property
+    def allowed_extensions(self):
+        return sorted(self._allowed)
+
+
+def _lowercase_keys(mapping):
+    return dict((key.lower(), value) for key, value in mapping.items())
+
+
+def build_video_registry():
+    types = _lowercase_keys(VIDEO_TYPE_MAP)
+    types.update(_lowercase_keys(getattr(settings, 'VIDEO_TYPE_MAP', {})))
+    mimetypes = _lowercase_keys(VIDEO_MIMETYPE_MAP)
+    mimetypes.update(
+        _lowercase_keys(getattr(settings, 'VIDEO_MIMETYPE_MAP', {})))
+    allowed = set(
+        extension.lower()
+        for extension in getattr(settings, 'ALLOWED_VIDEO_TYPES', []))
+
+    placeholders = {}
+    for extension in allowed | set(types) | set(mimetypes):
+        path = finders.find(PLACEHOLDER.format(extension), False)
+        if path:
+            placeholders[extension] = path
+    return VideoRegistry(
+        types, mimetypes, allowed, placeholders,
+        finders.find(PLACEHOLDER.format('generic'), False))
+
+
+def video_registry():
+    global _registry
+    if _registry is None:
+        _registry = build_video_registry()
+    return _registry
+
+
+def reload_video_registry():
+    global _registry
+    _registry = build_video_registry()
+    return _registry
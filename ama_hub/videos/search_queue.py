@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Queued search index updates.
+
+Saving a video only records its id in the ResourceIndexQueue table; the
+flush_video_index_queue task indexes the queued resources in bulk every few
+seconds. A video saved several times between two flushes is indexed once.
+Permission changes queue the resource, of any type, too, since its document
+lists who may view it; setting the permissions of a resource writes many
+permission rows. Saving a group profile queues the resources of its group,
+which its access decides the visibility of. Changes made by queryset
+updates, such as publishing resources in bulk, send no signal: queue those
+resources with enqueue_resource.
+Deletes are removed from the index immediately, so deleted resources never
+show up in search results. Saves of other models are indexed synchronously,
+as by haystack's RealtimeSignalProcessor.
+"""
+
+import logging
+
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+from haystack import connections as haystack_connections
+from haystack.exceptions import NotHandled
+from haystack.signals import RealtimeSignalProcessor
+
+logger = logging.getLogger(__name__)
+
+FLUSH_BATCH_SIZE = 500
+
+
+def enqueue_resource(resource_id):
+    from .models import ResourceIndexQueue
+
+    now = timezone.now()
+    queue = ResourceIndexQueue.objects
+    if not queue.filter(resource_id=resource_id).update(queued=now):
+        try:
+            with transaction.atomic():
+                queue.create(resource_id=resource_id, queued=now)
+        except IntegrityError:
+            queue.filter(resource_id=resource_id).update(queued=now)
+
+
+def enqueue_group_resources(group_id):
+    from geonode.base.models import ResourceBase
+
+    for resource_id in ResourceBase.objects.filter(
+            group_id=group_id).values_list('id', flat=True):
+        enqueue_resource(resource_id)
+
+
+def index_resources(ids, using='default'):
+    """
+    Updates the documents of the resources ``ids``, of any type, and
+    returns how many were indexed.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from geonode.base.models import ResourceBase
+
+    unified_index = haystack_connections[using].get_unified_index()
+    backend = haystack_connections[using].get_backend()
+    by_type = {}
+    for pk, ctype_id in ResourceBase.objects.filter(id__in=ids).values_list(
+            'id', 'polymorphic_ctype_id'):
+        by_type.setdefault(ctype_id, []).append(pk)
+
+    indexed = 0
+    for ctype_id, pks in by_type.items():
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+        try:
+            index = unified_index.get_index(model)
+        except NotHandled:
+            continue
+        objects = list(index.index_queryset(using=using).filter(pk__in=pks))
+        if objects:
+            backend.update(index, objects)
+        indexed += len(objects)
+    return indexed
+
+
+def flush_index_queue(using='default', batch_size=FLUSH_BATCH_SIZE):
+    """
+    Indexes the queued resources in batches of ``batch_size`` and returns
+    how many were indexed.
+
+    Queue entries are only removed if the resource was not queued again
+    while it was being indexed.
+    """
+    from .models import ResourceIndexQueue
+
+    queue = ResourceIndexQueue.objects
+    started = timezone.now()
+    indexed = 0
+    while True:
+        ids = list(queue.filter(queued__lte=started).order_by(
+            'queued').values_list('resource_id', flat=True)[:batch_size])
+        if not ids:
+            return indexed
+        indexed += index_resources(ids, using=using)
+        queue.filter(resource_id__in=ids, queued__lte=started).delete()
+
+
+class QueuedSignalProcessor(RealtimeSignalProcessor):
+
+    """
+    Signal processor queueing video saves for the flush task and indexing
+    every other change synchronously.
+    """
+
+    def handle_save(self, sender, instance, **kwargs):
+        from .models import Video
+
+        if isinstance(instance, Video):
+            try:
+                enqueue_resource(instance.pk)
+            except BaseException:
+                logger.exception('Could not queue video %s for indexing',
+                                 instance.pk)
+            return
+        super(QueuedSignalProcessor, self).handle_save(
+            sender, instance, **kwargs)
+
+    def setup(self):
+        from guardian.models import UserObjectPermission, GroupObjectPermission
+        from geonode.groups.models import GroupProfile
+
+        super(QueuedSignalProcessor, self).setup()
+        for model in (UserObjectPermission, GroupObjectPermission):
+            models.signals.post_save.connect(
+                self.handle_permission, sender=model)
+            models.signals.post_delete.connect(
+                self.handle_permission, sender=model)
+        models.signals.post_save.connect(
+            self.handle_group, sender=GroupProfile)
+
+    def teardown(self):
+        from guardian.models import UserObjectPermission, GroupObjectPermission
+        from geonode.groups.models import GroupProfile
+
+        super(QueuedSignalProcessor, self).teardown()
+        for model in (UserObjectPermission, GroupObjectPermission):
+            models.signals.post_save.disconnect(
+                self.handle_permission, sender=model)
+            models.signals.post_delete.disconnect(
+                self.handle_permission, sender=model)
+        models.signals.post_save.disconnect(
+            self.handle_group, sender=GroupProfile)
+
+    def handle_permission(self, sender, instance, **kwargs):
+        """
+        Queues the resource whose permissions changed, since its document
+        holds the principals allowed to view it.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        from geonode.base.models import ResourceBase
+
+        try:
+            if instance.content_type_id != \
+                    ContentType.objects.get_for_model(ResourceBase).id:
+                return
+            resource_id = int(instance.object_pk)
+            if ResourceBase.objects.filter(pk=resource_id).exists():
+                enqueue_resource(resource_id)
+        except BaseException:
+            logger.exception('Could not queue the resource of %s', instance)
+
+    def handle_group(self, sender, instance, created, **kwargs):
+        """
+        Queues the resources of a group whose profile changed, since a
+        private group limits who may view them.
+        """
+        if created or not instance.group_id:
+            return
+        try:
+            enqueue_group_resources(instance.group_id)
+        except BaseException:
+            logger.exception('Could not queue the resources of %s', instance)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        from geonode.base.models import ResourceBase
+        from .models import ResourceIndexQueue
+
+        if isinstance(instance, ResourceBase):
+            ResourceIndexQueue.objects.filter(
+                resource_id=instance.pk).delete()
+        super(QueuedSignalProcessor, self).handle_delete(
+            sender, instance, **kwargs)
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory prefix index for video title and keyword autocompletion.
+
+Every word of a public video's title, the whole title and each of its
+keywords are kept in a sorted list of ``(term, video id)`` pairs, and the
+titles in a second sorted list, so the suggestions for a prefix are a
+binary search in each plus a short scan. The index holds only the videos
+anonymous users can see, which keeps it independent of the user asking.
+
+Each change that can affect the suggestions (a video saved or deleted,
+the keywords of a video or a keyword renamed, the view permission of
+anonymous users on a video) is recorded, once committed, in a change log
+in the cache: the index version is bumped and the ids of the videos
+changed are stored under the new version. On its next lookup each process
+reads the versions it missed and replaces the terms of those videos only;
+it rebuilds its whole index when the log does not reach back far enough,
+and every ``SUGGEST_INDEX_TIMEOUT`` seconds.
+"""
+
+import bisect
+import heapq
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import signals
+
+SUGGEST_INDEX_TIMEOUT = getattr(settings, 'SUGGEST_INDEX_TIMEOUT', 600)
+
+VERSION_KEY = 'ama_hub:videos:suggest:version'
+CHANGE_KEY = 'ama_hub:videos:suggest:change:%s'
+
+# versions a process catches up with from the change log before it
+# rebuilds its index instead
+MAX_CHANGES = 200
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+_index = {
+    'version': None,
+    'built': 0,
+    'terms': [],
+    'titles': {},
+    'sorted_titles': [],
+}
+
+
+def _index_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _bump_version():
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        version = int(time.time() * 1000)
+        cache.set(VERSION_KEY, version, None)
+        return version
+
+
+def video_terms(title, keywords):
+    """
+    Returns the lowercased terms a video is suggested for.
+    """
+    title = (title or '').lower()
+    terms = set(WORDS.findall(title))
+    terms.add(title.strip())
+    terms.update(keyword.lower() for keyword in keywords if keyword)
+    terms.discard('')
+    return terms
+
+
+def public_video_entries(ids=None):
+    """
+    Returns ``{video id: (title, [keyword names])}`` for the public videos,
+    or for the public ones among ``ids``.
+    """
+    from geonode.base.models import ResourceBase
+    from ama_hub.facets import public_resources
+    from .models import Video
+
+    videos = public_resources(Video.objects.all())
+    if ids is not None:
+        videos = videos.filter(id__in=ids)
+    entries = dict((pk, (title, []))
+                   for pk, title in videos.values_list('id', 'title'))
+    keywords = ResourceBase.keywords.through.objects.filter(
+        content_object_id__in=list(entries)).values_list(
+        'content_object_id', 'tag__name')
+    for pk, name in keywords:
+        entries[pk][1].append(name)
+    return entries
+
+
+def sorted_titles(titles):
+    """
+    Returns the ``(lowercased title, video id)`` pairs of ``titles`` in
+    order.
+    """
+    return sorted(((title or '').lower(), pk) for pk, title in titles.items())
+
+
+def build_suggest_index():
+    terms = []
+    titles = {}
+    for pk, (title, keywords) in public_video_entries().items():
+        titles[pk] = title
+        terms.extend((term, pk) for term in video_terms(title, keywords))
+    terms.sort()
+    return terms, titles
+
+
+def _read_changes(since, version):
+    """
+    Returns the ids of the videos changed after version ``since`` up to
+    ``version``, or None when the change log does not cover them all.
+    """
+    if not 0 < version - since <= MAX_CHANGES:
+        return None
+    keys = [CHANGE_KEY % v for v in range(since + 1, version + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) < len(keys):
+        return None
+    return set(pk for ids in changes.values() for pk in ids)
+
+
+def _apply_changes(video_ids):
+    """
+    Replaces the terms of the videos ``video_ids`` in the index of this
+    process.
+    """
+    entries = public_video_entries(ids=video_ids)
+    titles = _index['titles']
+    added = []
+    for pk in video_ids:
+        titles.pop(pk, None)
+    for pk, (title, keywords) in entries.items():
+        titles[pk] = title
+        added.extend((term, pk) for term in video_terms(title, keywords))
+    _index['terms'] = list(heapq.merge(
+        [entry for entry in _index['terms'] if entry[1] not in video_ids],
+        sorted(added)))
+    _index['sorted_titles'] = list(heapq.merge(
+        [entry for entry in _index['sorted_titles']
+         if entry[1] not in video_ids],
+        sorted_titles(dict((pk, titles[pk]) for pk in entries))))
+
+
+def suggest_index():
+    version = _index_version()
+    if _index['version'] != version or \
+            time.time() - _index['built'] > SUGGEST_INDEX_TIMEOUT:
+        changes = None
+        if _index['version'] is not None and \
+                time.time() - _index['built'] <= SUGGEST_INDEX_TIMEOUT:
+            changes = _read_changes(_index['version'], version)
+        if changes is None:
+            _index['terms'], _index['titles'] = build_suggest_index()
+            _index['sorted_titles'] = sorted_titles(_index['titles'])
+            _index['built'] = time.time()
+        elif changes:
+            _apply_changes(changes)
+        _index['version'] = version
+    return _index
+
+
+def suggest(prefix, limit=10):
+    """
+    Returns up to ``limit`` ``(id, title)`` pairs of the public videos with
+    a title word, title or keyword starting with ``prefix``. Titles
+    starting with the prefix come first.
+    """
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+    index = suggest_index()
+    terms, titles = index['terms'], index['titles']
+
+    # the titles starting with the prefix, already in order
+    first = []
+    title_list = index['sorted_titles']
+    i = bisect.bisect_left(title_list, (prefix,))
+    while i < len(title_list) and title_list[i][0].startswith(prefix) and \
+            len(first) < limit:
+        first.append(title_list[i][1])
+        i += 1
+    if len(first) == limit:
+        return [(pk, titles[pk]) for pk in first]
+
+    others = set()
+    i = bisect.bisect_left(terms, (prefix,))
+    # scan a bounded window, enough to fill the limit after deduplication
+    while i < len(terms) and terms[i][0].startswith(prefix) and \
+            len(others) < limit * 5:
+        others.add(terms[i][1])
+        i += 1
+    others = sorted(others.difference(first),
+                    key=lambda pk: (titles[pk] or '').lower())
+    return [(pk, titles[pk]) for pk in first + others][:limit]
+
+
+def log_changes(video_ids):
+    """
+    Records, once the current transaction commits, that the suggestions of
+    ``video_ids`` changed.
+    """
+    video_ids = list(video_ids)
+    if not video_ids:
+        return
+
+    def log():
+        version = _bump_version()
+        cache.set(CHANGE_KEY % version, video_ids, SUGGEST_INDEX_TIMEOUT)
+
+    transaction.on_commit(log)
+
+
+def _video_ids(resource_ids):
+    from .models import Video
+
+    return Video.objects.filter(id__in=resource_ids).values_list(
+        'id', flat=True)
+
+
+def video_changed(sender, instance, **kwargs):
+    log_changes([instance.pk])
+
+
+def keywords_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    from .models import Video
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        if isinstance(instance, Video):
+            log_changes([instance.pk])
+    elif pk_set:
+        # keyword.resources.add(...): pk_set holds resource ids
+        log_changes(_video_ids(pk_set))
+
+
+def keyword_videos(keyword):
+    from geonode.base.models import ResourceBase
+
+    return _video_ids(ResourceBase.keywords.through.objects.filter(
+        tag=keyword).values('content_object_id'))
+
+
+def keyword_saved(sender, instance, **kwargs):
+    log_changes(keyword_videos(instance))
+
+
+def keyword_deleting(sender, instance, **kwargs):
+    # read before the tagged items are deleted with the keyword
+    log_changes(keyword_videos(instance))
+
+
+def permission_changed(sender, instance, **kwargs):
+    from ama_hub.facets import affects_visibility
+
+    if affects_visibility(instance):
+        log_changes(_video_ids([instance.object_pk]))
+
+
+def connect_suggest_signals():
+    from geonode.base.models import HierarchicalKeyword, ResourceBase
+    from guardian.models import UserObjectPermission, GroupObjectPermission
+    from .models import Video
+
+    for signal in (signals.post_save, signals.post_delete):
+        signal.connect(video_changed, sender=Video,
+                       dispatch_uid='ama_hub.videos.suggest.video_changed')
+        for model in (UserObjectPermission, GroupObjectPermission):
+            signal.connect(
+                permission_changed, sender=model,
+                dispatch_uid='ama_hub.videos.suggest.permission_changed')
+    signals.post_save.connect(
+        keyword_saved, sender=HierarchicalKeyword,
+        dispatch_uid='ama_hub.videos.suggest.keyword_saved')
+    signals.pre_delete.connect(
+        keyword_deleting, sender=HierarchicalKeyword,
+        dispatch_uid='ama_hub.videos.suggest.keyword_deleting')
+    signals.m2m_changed.connect(
+        keywords_changed, sender=ResourceBase.keywords.through,
+        dispatch_uid='ama_hub.videos.suggest.keywords_changed')
@@ -75,6 +75,37 @@ def delete_orphaned_video_files(self):
     from ama_hub.videos.utils import delete_orphaned_video_files
     delete_orphaned_video_files()
 
+
+@shared_task(bind=True, queue='update')
+def reconcile_facet_counters(self):
+    """
+    Rebuild the precomputed facet counters from the resources table.
+    """
+    from ama_hub.facets import reconcile_facet_counters
+    reconcile_facet_counters()
+
+
+@shared_task(bind=True, queue='update')
+def flush_video_index_queue(self):
+    """
+    Index the resources queued since the last flush.
+    """
+    from ama_hub.videos.search_queue import flush_index_queue
+    indexed = flush_index_queue()
+    if indexed:
+        logger.debug("Indexed {} queued resources.".format(indexed))
+
+
+@shared_task(bind=True, queue='update')
+def flush_video_hits(self):
+    """
+    Add the buffered video views to popular_count.
+    """
+    from ama_hub.videos.popularity import flush_video_hits
+    flushed = flush_video_hits()
+    if flushed:
+        logger.debug("Flushed {} video views.".format(flushed))
+
 # @shared_task(bind=True, queue='cleanup')
 # def delete_orphaned_thumbnails(self):
 #     from geonode.documents.utils import delete_orphaned_thumbs
@@ -1,6 +1,1310 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import json
+import os
+import random
+import sys
+import threading
+import time
+import unittest
+import uuid
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Group
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.forms import ValidationError
+from django.db import DEFAULT_DB_ALIAS, connection
+from django.db.models import Count, Q
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import translation
+
+from guardian.shortcuts import assign_perm, get_objects_for_user, remove_perm
+from guardian.utils import get_anonymous_user
+
+from geonode.base.models import HierarchicalKeyword, ResourceBase
+from geonode.documents.models import Document
+from geonode.favorite.models import Favorite
+from geonode.groups.models import GroupProfile
+from geonode.layers.models import Layer
+from geonode.maps.models import Map
+from geonode.security.utils import get_visible_resources
+
+from ama_hub import counts, fulltext, keywords
+from ama_hub.api_cache import ApiCacheMiddleware
+from ama_hub.counts import planner_estimate
+from ama_hub.facets import (
+    compute_facets, count_types, counters_fresh, public_resources,
+    reconcile_facet_counters, resource_saved, resource_saving)
+from ama_hub.keywords import keyword_subtree_ids
+from ama_hub.resourcebase_api import (
+    FILTER_TYPES, LAYER_SUBTYPES, CountingPaginator, type_filter)
+from ama_hub.search_query import resource_principals, user_principals
+from ama_hub.spatial import filter_bbox, parse_bbox
+from ama_hub.templatetags.resource_tags import related_videos
+from ama_hub.views import FAVORITE_STATES_MAX
+from .forms import LinkChoicesField, VideoFormMixin, search_link_choices
+from .models import (
+    FacetCounter, ModFavorite, ResourceSearchDocument, Video,
+    VideoResourceLink, get_related_resources, get_related_videos,
+    get_related_videos_bulk, related_video_ids, update_video_extent,
+    update_video_extents)
+from .popularity import flush_video_hits, pending_hits, record_hit
+from .suggest import _index as suggest_index, suggest, video_changed
+
+# the benchmarks seed large catalogues and only run when this is set, e.g.
+# AMA_HUB_BENCHMARKS=1 python manage.py test ama_hub.videos
+BENCHMARKS = bool(os.getenv('AMA_HUB_BENCHMARKS'))
+
+INSERT_BATCH_SIZE = 1000
+
+# one local memory cache, shared by the threads of the test process
+SHARED_CACHE = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ama_hub-videos-tests',
+    },
+}
+
+
+def run_on_commit():
+    # TestCase never commits, so the callbacks registered with
+    # transaction.on_commit are run by hand
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for _, callback in callbacks:
+        callback()
+
+
+def _insert_children(model, parent_ids, **values):
+    # child rows of already inserted ResourceBase rows; bulk_create does not
+    # support multi-table inheritance and save() would run GeoNode's signals
+    for start in range(0, len(parent_ids), INSERT_BATCH_SIZE):
+        model._base_manager._insert(
+            [model(resourcebase_ptr_id=pk, **values)
+             for pk in parent_ids[start:start + INSERT_BATCH_SIZE]],
+            fields=model._meta.local_concrete_fields,
+            using=DEFAULT_DB_ALIAS)
+
+
+def seed_resources(count, extent=None, seed=0):
+    """
+    Inserts ``count`` resources without running their save signals and
+    returns their ids: mostly layers of every ``LAYER_SUBTYPES`` store type
+    (a third of the vector ones with time), then maps, documents and
+    videos. ``extent(random)`` returns the (x0, y0, x1, y1) of each.
+
+    Every resource gets its child row, but no other related row.
+    """
+    rng = random.Random(seed)
+    ctype_ids = dict(
+        (model, ContentType.objects.get_for_model(model).id)
+        for model in (Layer, Map, Document, Video))
+    kinds = [(Layer, store_type) for store_type in
+             sorted(set(LAYER_SUBTYPES.values()))] * 3 + [
+        (Map, None), (Document, None), (Video, None)]
+
+    rows = []
+    for i in range(count):
+        model, store_type = kinds[i % len(kinds)]
+        x0, y0, x1, y1 = extent(rng) if extent else (None,) * 4
+        rows.append((model, store_type, ResourceBase(
+            uuid=str(uuid.UUID(int=rng.getrandbits(128))),
+            title='Resource %s' % i,
+            polymorphic_ctype_id=ctype_ids[model],
+            bbox_x0=x0, bbox_y0=y0, bbox_x1=x1, bbox_y1=y1)))
+    ResourceBase.objects.bulk_create(
+        [resource for _, _, resource in rows], batch_size=INSERT_BATCH_SIZE)
+
+    layers = {}
+    for i, (model, store_type, resource) in enumerate(rows):
+        if model is Layer:
+            has_time = store_type == LAYER_SUBTYPES['vector'] and i % 3 == 0
+            layers.setdefault((store_type, has_time), []).append(resource.pk)
+    for (store_type, has_time), ids in layers.items():
+        _insert_children(
+            Layer, ids, storeType=store_type, has_time=has_time,
+            name='layer', typename='geonode:layer', workspace='geonode')
+    children = dict(
+        (model, [resource.pk for kind, _, resource in rows if kind is model])
+        for model in (Map, Document, Video))
+    _insert_children(Map, children[Map], zoom=0, projection='EPSG:3857',
+                     center_x=0, center_y=0)
+    _insert_children(Document, children[Document], doc_type='text')
+    _insert_children(Video, children[Video], video_type='video')
+    return [resource.pk for _, _, resource in rows]
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ANALYZE ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def best_time(queryset, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        list(queryset.values_list('id', flat=True))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, old, new):
+    """
+    Writes the best latency of the ``old`` and ``new`` querysets and, on
+    PostgreSQL, their query plans.
+    """
+    lines = ['', '== %s: old %.1f ms, new %.1f ms' % (
+        name, best_time(old) * 1000, best_time(new) * 1000)]
+    if connection.vendor == 'postgresql':
+        lines += ['-- old plan', explain(old), '-- new plan', explain(new)]
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def legacy_type_filter(queryset, types):
+    # the per-type querysets OR-ed together by apply_filters before
+    # type_filter replaced them
+    filtered = None
+    for the_type in types:
+        if the_type in LAYER_SUBTYPES.keys():
+            super_type = 'vector' if 'vector_time' == the_type else the_type
+            selected = queryset.filter(
+                Layer___storeType=LAYER_SUBTYPES[super_type])
+            if 'time' in the_type:
+                selected = selected.exclude(Layer___has_time=False)
+        else:
+            selected = queryset.instance_of(FILTER_TYPES[the_type])
+        filtered = selected if filtered is None else filtered | selected
+    return filtered
+
+
+class TypeFilterTest(TestCase):
+
+    """
+    ``type_filter`` selects the same resources as the OR-ed per-type
+    querysets it replaced.
+    """
+
+    resources = 120
+    benchmark = False
+
+    TYPES = (
+        ['layer'],
+        ['vector'],
+        ['vector_time'],
+        ['raster', 'vector'],
+        ['map', 'document', 'video'],
+        ['vector', 'map', 'video'],
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(cls.resources)
+
+    def test_type_filter(self):
+        queryset = ResourceBase.objects.all()
+        for types in self.TYPES:
+            new = queryset.filter(type_filter(ResourceBase, types))
+            old = legacy_type_filter(queryset, types)
+            self.assertEqual(
+                set(new.values_list('id', flat=True)),
+                set(old.values_list('id', flat=True)), types)
+            if self.benchmark:
+                report('type__in=%s' % ','.join(types), old, new)
+
+
+@unittest.skipUnless(BENCHMARKS, 'set AMA_HUB_BENCHMARKS to run')
+class TypeFilterBenchmark(TypeFilterTest):
+
+    resources = 100000
+    benchmark = True
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class CountingPaginatorTest(TestCase):
+
+    """
+    ``CountingPaginator`` counts the result set once per count key and
+    reports the planner estimate above ``API_ESTIMATED_COUNT_THRESHOLD``.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(30)
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(setattr, counts, 'ESTIMATED_COUNT_THRESHOLD',
+                        counts.ESTIMATED_COUNT_THRESHOLD)
+
+    def meta(self, key=None):
+        paginator = CountingPaginator(
+            {}, ResourceBase.objects.order_by('id'),
+            resource_uri='/api/base/', limit=10)
+        paginator.count_key = key
+        return paginator.page()['meta']
+
+    def test_exact_count(self):
+        counts.ESTIMATED_COUNT_THRESHOLD = 0
+        meta = self.meta()
+        self.assertEqual(meta['total_count'], ResourceBase.objects.count())
+        self.assertFalse(meta['total_count_estimated'])
+
+    def test_memoised_count(self):
+        counts.ESTIMATED_COUNT_THRESHOLD = 0
+        with self.assertNumQueries(1):
+            first = self.meta(key='counting-paginator-test')
+        # the page itself is not evaluated by page()
+        with self.assertNumQueries(0):
+            second = self.meta(key='counting-paginator-test')
+        self.assertEqual(first, second)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql',
+                         'the estimate comes from the PostgreSQL planner')
+    def test_estimated_count(self):
+        estimate = planner_estimate(ResourceBase.objects.all())
+        counts.ESTIMATED_COUNT_THRESHOLD = estimate - 1
+        meta = self.meta()
+        self.assertEqual(meta['total_count'], estimate)
+        self.assertTrue(meta['total_count_estimated'])
+
+        # below the threshold the count is exact again
+        counts.ESTIMATED_COUNT_THRESHOLD = estimate
+        meta = self.meta()
+        self.assertEqual(meta['total_count'], ResourceBase.objects.count())
+        self.assertFalse(meta['total_count_estimated'])
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class ApiCacheTest(TestCase):
+
+    """
+    Anonymous API responses are served from the cache per language until a
+    resource of their type is saved or an anonymous permission changes.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(12)
+        cls.video = Video.objects.order_by('id')[0]
+
+    def setUp(self):
+        cache.clear()
+        self.rendered = 0
+        self.middleware = ApiCacheMiddleware(self.view)
+
+    def view(self, request):
+        self.rendered += 1
+        return HttpResponse('{"render": %s}' % self.rendered,
+                            content_type='application/json')
+
+    def get(self, path='/api/videos/', **extra):
+        request = RequestFactory().get(path, **extra)
+        request.user = AnonymousUser()
+        return self.middleware(request)
+
+    def test_hit_and_miss(self):
+        first = self.get()
+        second = self.get()
+        self.assertEqual(self.rendered, 1)
+        self.assertEqual(first.content, second.content)
+        for response in (first, second):
+            vary = [h.strip() for h in response['Vary'].split(',')]
+            self.assertIn('Accept-Language', vary)
+            self.assertIn('Cookie', vary)
+
+        self.get('/api/videos/?limit=5')
+        self.assertEqual(self.rendered, 2)
+        # the cache buster is not part of the key
+        self.get('/api/videos/?_=1')
+        self.assertEqual(self.rendered, 2)
+
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.rendered, 1)
+
+    def test_language(self):
+        self.get()
+        with translation.override('fr'):
+            self.get()
+            self.get()
+        self.assertEqual(self.rendered, 2)
+
+    def test_invalidation(self):
+        self.get()
+        self.get('/api/layers/search/')
+        ResourceBase.objects.non_polymorphic().get(
+            pk=self.video.pk).save(update_fields=['title'])
+        self.get()
+        # a video does not invalidate the layer search
+        self.get('/api/layers/search/')
+        self.assertEqual(self.rendered, 3)
+
+        assign_perm('view_resourcebase', get_anonymous_user(),
+                    self.video.get_self_resource())
+        self.get()
+        self.get('/api/layers/search/')
+        self.assertEqual(self.rendered, 5)
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class KeywordTreeTest(TestCase):
+
+    """
+    The keyword subtree index is rebuilt when a keyword is saved or deleted
+    and otherwise served without a query.
+    """
+
+    def setUp(self):
+        cache.clear()
+        keywords._tree['version'] = None
+        self.water = HierarchicalKeyword.add_root(name='Water', slug='water')
+        self.rivers = self.water.add_child(name='Rivers', slug='rivers')
+
+    def test_subtree(self):
+        self.assertEqual(keyword_subtree_ids(['WATER']),
+                         sorted([self.water.pk, self.rivers.pk]))
+        self.assertEqual(keyword_subtree_ids(['rivers', 'unknown']),
+                         [self.rivers.pk])
+        with self.assertNumQueries(0):
+            keyword_subtree_ids(['water'])
+
+    def test_invalidation(self):
+        keyword_subtree_ids(['water'])
+        deltas = HierarchicalKeyword.objects.get(
+            pk=self.rivers.pk).add_child(name='Deltas', slug='deltas')
+        self.assertEqual(
+            keyword_subtree_ids(['water']),
+            sorted([self.water.pk, self.rivers.pk, deltas.pk]))
+
+        HierarchicalKeyword.objects.filter(pk=deltas.pk).delete()
+        self.assertEqual(keyword_subtree_ids(['water']),
+                         sorted([self.water.pk, self.rivers.pk]))
+        self.assertEqual(keyword_subtree_ids(['deltas']), [])
+
+
+def random_extent(rng):
+    # one extent in ten crosses the antimeridian
+    width, height = rng.uniform(0.1, 20), rng.uniform(0.1, 20)
+    y0 = rng.uniform(-90, 90 - height)
+    if rng.random() < 0.1:
+        x0 = rng.uniform(180 - width, 180)
+        return x0, y0, x0 + width - 360, y0 + height
+    x0 = rng.uniform(-180, 180 - width)
+    return x0, y0, x0 + width, y0 + height
+
+
+def extent_intersects(extent, box):
+    x0, y0, x1, y1 = [float(v) for v in extent]
+    bx0, by0, bx1, by1 = box
+    if y0 > by1 or y1 < by0:
+        return False
+    if x0 > x1:
+        return x0 <= bx1 or x1 >= bx0
+    return not (x0 > bx1 or x1 < bx0)
+
+
+def legacy_filter_bbox(queryset, bbox):
+    # the four-column range predicate filter_bbox replaced
+    left, bottom, right, top = bbox.split(',')
+    return queryset.filter(
+        ~(Q(bbox_x0__gt=right) | Q(bbox_x1__lt=left) |
+          Q(bbox_y0__gt=top) | Q(bbox_y1__lt=bottom)))
+
+
+class BboxFilterTest(TestCase):
+
+    """
+    ``filter_bbox`` matches the extents intersecting the box, including
+    extents and boxes crossing the antimeridian, on querysets of
+    ResourceBase and of its subclasses.
+    """
+
+    resources = 300
+    benchmark = False
+
+    BBOXES = (
+        '-10,-10,10,10',
+        '100,20,140,60',
+        '170,-30,-170,30',
+        '-180,-90,180,90',
+        '175,-90,180,90',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(cls.resources, extent=random_extent)
+
+    def expected(self, queryset, bbox):
+        boxes = parse_bbox(bbox)
+        return set(
+            row[0] for row in queryset.values_list(
+                'id', 'bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1')
+            if any(extent_intersects(row[1:], box) for box in boxes))
+
+    def test_filter_bbox(self):
+        for queryset in (ResourceBase.objects.all(), Video.objects.all()):
+            for bbox in self.BBOXES:
+                filtered = filter_bbox(queryset, bbox)
+                expected = self.expected(queryset, bbox)
+                self.assertEqual(
+                    set(filtered.values_list('id', flat=True)), expected, bbox)
+                # the base_resourcebase join must survive count() on
+                # subclass querysets
+                self.assertEqual(filtered.count(), len(expected), bbox)
+                if self.benchmark and queryset.model is ResourceBase:
+                    report('extent=%s' % bbox,
+                           legacy_filter_bbox(queryset, bbox), filtered)
+
+
+@unittest.skipUnless(BENCHMARKS, 'set AMA_HUB_BENCHMARKS to run')
+class BboxFilterBenchmark(BboxFilterTest):
+
+    resources = 1000000
+    benchmark = True
+
+
+def plain_extent(rng):
+    # extents not crossing the antimeridian, which the legacy filters missed
+    x0, y0 = rng.uniform(-180, 160), rng.uniform(-90, 70)
+    return x0, y0, x0 + rng.uniform(0.1, 20), y0 + rng.uniform(0.1, 20)
+
+
+def legacy_facets(request, facet_type):
+    # the per-type querysets the facets template tag counted before
+    # count_types, for the owner and extent filters; the tag ignored the
+    # extent on the video and document facets, count_types does not
+    params = request.GET
+
+    def filtered(model):
+        queryset = model.objects.all()
+        if params.getlist('owner__username__in'):
+            queryset = queryset.filter(
+                owner__username__in=params.getlist('owner__username__in'))
+        queryset = get_visible_resources(
+            queryset,
+            request.user,
+            admin_approval_required=settings.ADMIN_MODERATE_UPLOADS,
+            unpublished_not_visible=settings.RESOURCE_PUBLISHING,
+            private_groups_not_visibile=settings.GROUP_PRIVATE_RESOURCES)
+        if params.get('extent'):
+            queryset = legacy_filter_bbox(queryset, params.get('extent'))
+        return queryset.filter(id__in=get_objects_for_user(
+            request.user, 'base.view_resourcebase').values('id'))
+
+    def grouped(queryset, field):
+        return dict((row[field], row['count']) for row in queryset.values(
+            field).annotate(count=Count(field)).order_by() if row['count'])
+
+    if facet_type == 'videos':
+        return grouped(filtered(Video), 'video_type')
+    if facet_type == 'documents':
+        return grouped(filtered(Document), 'doc_type')
+
+    layers = filtered(Layer)
+    store_types = grouped(layers, 'storeType')
+    facets = {
+        'raster': store_types.get('coverageStore', 0),
+        'vector': store_types.get('dataStore', 0),
+        'vector_time': layers.exclude(has_time=False).filter(
+            storeType='dataStore').count(),
+        'remote': store_types.get('remoteStore', 0),
+        'wms': store_types.get('wmsStore', 0),
+    }
+    if facet_type == 'layers':
+        return facets
+    facets['map'] = filtered(Map).count()
+    facets['document'] = filtered(Document).count()
+    facets['video'] = filtered(Video).count()
+    return facets
+
+
+class FacetParityTest(TestCase):
+
+    """
+    ``count_types`` yields the facets the per-type querysets it replaced
+    counted.
+    """
+
+    FACET_TYPES = ('all', 'layers', 'videos', 'documents')
+    QUERIES = ('', 'owner__username__in=owner', 'extent=-60,-30,60,30')
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.owner = User.objects.create_user('owner')
+        cls.viewer = User.objects.create_user('viewer')
+        ids = seed_resources(90, extent=plain_extent)
+        ResourceBase.objects.filter(id__in=ids[::2]).update(owner=cls.owner)
+        ResourceBase.objects.filter(id__in=ids[::5]).update(is_published=False)
+        anonymous = get_anonymous_user()
+        resources = ResourceBase.objects.non_polymorphic().filter(
+            id__in=ids).order_by('id')
+        for i, resource in enumerate(resources):
+            if i % 3:
+                assign_perm('view_resourcebase', cls.viewer, resource)
+            if i % 4 == 0:
+                assign_perm('view_resourcebase', anonymous, resource)
+
+    def setUp(self):
+        # the precomputed counters are stale, so every facet is counted
+        cache.clear()
+
+    def assert_same_facets(self):
+        for user in (AnonymousUser(), self.viewer):
+            for query in self.QUERIES:
+                request = RequestFactory().get('/', query)
+                request.user = user
+                for facet_type in self.FACET_TYPES:
+                    self.assertEqual(
+                        compute_facets(request, facet_type),
+                        legacy_facets(request, facet_type),
+                        (user, query, facet_type))
+
+    def test_facets(self):
+        self.assert_same_facets()
+
+    @override_settings(RESOURCE_PUBLISHING=True)
+    def test_facets_unpublished(self):
+        self.assert_same_facets()
+
+
+def legacy_visible_ids(user):
+    # the ids permission_filter sent with each search before the indexes
+    # held the permission principals
+    visible = get_visible_resources(
+        get_objects_for_user(user, 'base.view_resourcebase'),
+        user,
+        admin_approval_required=settings.ADMIN_MODERATE_UPLOADS,
+        unpublished_not_visible=settings.RESOURCE_PUBLISHING,
+        private_groups_not_visibile=settings.GROUP_PRIVATE_RESOURCES)
+    return set(visible.values_list('id', flat=True))
+
+
+class PermissionPrincipalsTest(TestCase):
+
+    """
+    The principals indexed with the resources select, for each user, the
+    resources whose ids were sent with the search query before.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.owner = User.objects.create_user('owner')
+        cls.member = User.objects.create_user('member')
+        cls.outsider = User.objects.create_user('outsider')
+        cls.insider = User.objects.create_user('insider')
+        group = Group.objects.create(name='team')
+        cls.member.groups.add(group)
+        # a private group, whose members see its unpublished resources
+        cls.private = private = GroupProfile.objects.create(
+            title='Private team', slug='private-team', access='private')
+        private.join(cls.insider)
+
+        ids = seed_resources(80)
+        ResourceBase.objects.filter(id__in=ids).update(owner=cls.owner)
+        ResourceBase.objects.filter(id__in=ids[::3]).update(is_published=False)
+        ResourceBase.objects.filter(id__in=ids[::2]).update(
+            group=private.group)
+        grantees = ([get_anonymous_user()], [cls.member], [group],
+                    [cls.outsider, group], [private.group],
+                    [cls.insider], [cls.insider, group], [])
+        resources = ResourceBase.objects.non_polymorphic().filter(
+            id__in=ids).order_by('id')
+        for i, resource in enumerate(resources):
+            # GeoNode grants owners the view permission by default
+            assign_perm('view_resourcebase', cls.owner, resource)
+            for grantee in grantees[i % len(grantees)]:
+                assign_perm('view_resourcebase', grantee, resource)
+
+    def assert_same_resources(self):
+        principals = dict(
+            (resource.pk, set(resource_principals(resource)))
+            for resource in ResourceBase.objects.non_polymorphic())
+        for user in (AnonymousUser(), self.owner, self.member, self.outsider,
+                     self.insider):
+            allowed = set(user_principals(user))
+            self.assertEqual(
+                set(pk for pk, held in principals.items() if held & allowed),
+                legacy_visible_ids(user), user)
+
+    def test_principals(self):
+        self.assert_same_resources()
+
+    @override_settings(RESOURCE_PUBLISHING=True)
+    def test_principals_unpublished(self):
+        self.assert_same_resources()
+
+    @override_settings(GROUP_PRIVATE_RESOURCES=True)
+    def test_principals_private_groups(self):
+        self.assert_same_resources()
+
+    @override_settings(RESOURCE_PUBLISHING=True, GROUP_PRIVATE_RESOURCES=True)
+    def test_principals_unpublished_private_groups(self):
+        self.assert_same_resources()
+        # an unpublished resource of the private group, seen by its member
+        # through the group permission
+        unpublished = ResourceBase.objects.filter(
+            is_published=False, group=self.private.group,
+            id__in=get_objects_for_user(
+                self.insider, 'base.view_resourcebase').values('id'))
+        self.assertTrue(unpublished.exists())
+        self.assertTrue(set(unpublished.values_list('id', flat=True)) <=
+                        legacy_visible_ids(self.insider))
+
+
+
+@override_settings(CACHES=SHARED_CACHE, VIDEO_HITS_BUFFERED=True)
+class VideoHitsTest(TestCase):
+
+    """
+    Every buffered view reaches ``popular_count``, however the views and
+    the flushes interleave.
+    """
+
+    threads = 8
+    hits = 500
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(60)
+        cls.video_ids = list(Video.objects.values_list('id', flat=True))
+
+    def setUp(self):
+        cache.clear()
+
+    def popular_counts(self):
+        return dict(ResourceBase.objects.filter(
+            id__in=self.video_ids).values_list('id', 'popular_count'))
+
+    def viewed(self, seed):
+        rng = random.Random(seed)
+        return [rng.choice(self.video_ids) for _ in range(self.hits)]
+
+    def test_no_lost_hits(self):
+        before = self.popular_counts()
+
+        def view(seed):
+            for video_id in self.viewed(seed):
+                record_hit(video_id)
+
+        workers = [threading.Thread(target=view, args=(seed,))
+                   for seed in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            flush_video_hits(batch_size=2)
+        for worker in workers:
+            worker.join()
+        # a flush reads the videos logged before the previous one
+        flush_video_hits()
+        flush_video_hits()
+
+        expected = dict(before)
+        for seed in range(self.threads):
+            for video_id in self.viewed(seed):
+                expected[video_id] += 1
+        self.assertEqual(self.popular_counts(), expected)
+        self.assertEqual(sum(pending_hits(self.video_ids).values()), 0)
+
+    def test_hits_without_shared_cache(self):
+        video_id = self.video_ids[0]
+        dummy = {'default': {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+        # views go to the database when the cache is not shared, or cannot
+        # keep the counter
+        for buffered in (None, True):
+            before = self.popular_counts()[video_id]
+            with override_settings(CACHES=dummy, VIDEO_HITS_BUFFERED=buffered):
+                record_hit(video_id)
+            self.assertEqual(self.popular_counts()[video_id], before + 1)
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class FacetCounterTest(TestCase):
+
+    """
+    The counters updated by the resource and permission signals hold the
+    counts ``reconcile_facet_counters`` rebuilds from the resources.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        ids = seed_resources(60)
+        anonymous = get_anonymous_user()
+        for resource in ResourceBase.objects.non_polymorphic().filter(
+                id__in=ids[::3]):
+            assign_perm('view_resourcebase', anonymous, resource)
+
+    def setUp(self):
+        cache.clear()
+
+    def counters(self):
+        return dict(
+            ((row.resource_type, row.subtype, row.visibility), row.count)
+            for row in FacetCounter.objects.all() if row.count)
+
+    def save(self, resource, **values):
+        # what saving does to the counters, without the other save signals
+        resource_saving(resource)
+        for name, value in values.items():
+            setattr(resource, name, value)
+        type(resource)._base_manager.filter(pk=resource.pk).update(**values)
+        resource_saved(resource, False)
+
+    def test_reconcile(self):
+        reconcile_facet_counters()
+        self.assertTrue(counters_fresh())
+        public, total = {}, {}
+        for (model, subtype, visibility), count in self.counters().items():
+            total[(model, subtype)] = total.get((model, subtype), 0) + count
+            if visibility == 'public':
+                public[(model, subtype)] = \
+                    public.get((model, subtype), 0) + count
+        self.assertEqual(total, count_types(ResourceBase.objects.all()))
+        self.assertEqual(
+            public, count_types(public_resources(ResourceBase.objects.all())))
+
+    def test_incremental_updates(self):
+        reconcile_facet_counters()
+        video = Video.objects.order_by('id')[0]
+        restricted = Video.objects.exclude(pk=video.pk).exclude(
+            id__in=public_resources(Video.objects.all()).values('id'))[0]
+        deleted = Video.objects.exclude(
+            pk__in=[video.pk, restricted.pk]).order_by('-id')[0]
+
+        # a save not touching the counted columns costs no query
+        video.title = 'Renamed'
+        with self.assertNumQueries(0):
+            resource_saving(video)
+            resource_saved(video, False)
+
+        self.save(video, video_type='image')
+        assign_perm('view_resourcebase', get_anonymous_user(),
+                    restricted.get_self_resource())
+        deleted.delete()
+        # loaded with deferred counted columns
+        self.save(Layer.objects.only('id', 'polymorphic_ctype_id').order_by(
+            'id')[0], storeType='coverageStore')
+
+        incremental = self.counters()
+        reconcile_facet_counters()
+        self.assertEqual(incremental, self.counters())
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class SuggestTest(TestCase):
+
+    """
+    Titles starting with the prefix are suggested first, however many other
+    terms match it, and each process catches up with the change log without
+    rebuilding its index.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(71 * 15)
+        cls.videos = list(Video.objects.order_by('id'))
+        # the 'flood' terms of the lowest ids fill the scanned window
+        titles = ['Coastal flood %02d' % i for i in range(60)] + \
+            ['Flood risk %02d' % i for i in range(10)] + ['Flood private']
+        anonymous = get_anonymous_user()
+        for video, title in zip(cls.videos, titles):
+            ResourceBase.objects.filter(pk=video.pk).update(title=title)
+            if title != 'Flood private':
+                assign_perm('view_resourcebase', anonymous,
+                            video.get_self_resource())
+        cls.flood_risk = [video.pk for video in cls.videos[60:70]]
+
+    def setUp(self):
+        cache.clear()
+        suggest_index['version'] = None
+
+    def test_title_prefix_first(self):
+        self.assertEqual([pk for pk, _ in suggest('flo')], self.flood_risk)
+        results = suggest('FLO', limit=15)
+        self.assertEqual([pk for pk, _ in results[:10]], self.flood_risk)
+        self.assertEqual([title for _, title in results[10:]],
+                         ['Coastal flood %02d' % i for i in range(5)])
+        expected = Video.objects.filter(
+            title__startswith='Coastal flood 1').order_by('title')
+        self.assertEqual(suggest('coastal flood 1', limit=20),
+                         [(video.pk, video.title) for video in expected])
+
+    def test_change_log(self):
+        suggest('flo')
+        built = suggest_index['built']
+
+        renamed = Video.objects.get(pk=self.videos[0].pk)
+        ResourceBase.objects.filter(pk=renamed.pk).update(title='Flooded coast')
+        video_changed(Video, renamed)
+        revoked = self.videos[60]
+        remove_perm('view_resourcebase', get_anonymous_user(),
+                    revoked.get_self_resource())
+        run_on_commit()
+
+        results = suggest('flo', limit=11)
+        # the changes were applied to the index instead of rebuilding it
+        self.assertEqual(suggest_index['built'], built)
+        self.assertEqual([pk for pk, _ in results],
+                         self.flood_risk[1:] + [renamed.pk, self.videos[1].pk])
+        self.assertNotIn(renamed.pk,
+                         [pk for pk, _ in suggest('coastal', limit=100)])
+
+
+class SearchResourcesTest(TestCase):
+
+    """
+    ``search_resources`` ranks title matches above abstract matches with
+    full-text search, and falls back to ``title__icontains`` without it.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        ids = seed_resources(15)
+        cls.ids = ids
+        cls.title_match, cls.abstract_match, cls.other = ids[:3]
+        for pk, title, abstract in (
+                (cls.title_match, 'Flood extent', 'Rivers'),
+                (cls.abstract_match, 'Rivers', 'After the flood'),
+                (cls.other, 'Roads', 'Roads')):
+            ResourceBase.objects.filter(pk=pk).update(
+                title=title, abstract=abstract)
+
+    def search(self, text, rank=False):
+        return list(fulltext.search_resources(
+            ResourceBase.objects.order_by('id'), text,
+            rank=rank).values_list('id', flat=True))
+
+    @override_settings(FULLTEXT_SEARCH=False)
+    def test_fallback(self):
+        self.assertEqual(self.search('flood+extent'), [self.title_match])
+        self.assertEqual(self.search('flood'), [self.title_match])
+        self.assertEqual(self.search('  '), list(
+            ResourceBase.objects.order_by('id').values_list('id', flat=True)))
+
+    @unittest.skipUnless(connection.vendor == 'postgresql',
+                         'full-text search requires PostgreSQL')
+    @override_settings(FULLTEXT_SEARCH=True, HAYSTACK_SEARCH=False)
+    def test_ranking(self):
+        fulltext.refresh_on_commit(self.ids)
+        # the documents are built once the transaction commits
+        self.assertFalse(ResourceSearchDocument.objects.exists())
+        run_on_commit()
+        self.assertEqual(ResourceSearchDocument.objects.count(), len(self.ids))
+
+        self.assertEqual(self.search('flood', rank=True),
+                         [self.title_match, self.abstract_match])
+        self.assertEqual(self.search('rivers flood'),
+                         [self.title_match, self.abstract_match])
+        self.assertEqual(self.search('roads'), [self.other])
+
+
+@override_settings(CACHES=SHARED_CACHE, HAYSTACK_SEARCH=False)
+class VideoExtentTest(TestCase):
+
+    """
+    The extent of a video becomes the union of the extents of the layers
+    and maps linked to it, with a number of queries independent of the
+    number of videos.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(60, extent=plain_extent)
+        cls.map = Map.objects.order_by('id')[0]
+        cls.layer = Layer.objects.order_by('id')[0]
+        cls.videos = list(Video.objects.order_by('id')[:4])
+        map_ct = ContentType.objects.get_for_model(Map)
+        layer_ct = ContentType.objects.get_for_model(Layer)
+        VideoResourceLink.objects.bulk_create(
+            [VideoResourceLink(video=video, content_type=map_ct,
+                               object_id=cls.map.pk)
+             for video in cls.videos[:3]] +
+            [VideoResourceLink(video=cls.videos[0], content_type=layer_ct,
+                               object_id=cls.layer.pk)])
+
+    def setUp(self):
+        cache.clear()
+
+    def extent(self, pk):
+        return tuple(ResourceBase.objects.filter(pk=pk).values_list(
+            'bbox_x0', 'bbox_x1', 'bbox_y0', 'bbox_y1')[0])
+
+    def assert_extents(self):
+        (mx0, mx1, my0, my1), (lx0, lx1, ly0, ly1) = \
+            self.extent(self.map.pk), self.extent(self.layer.pk)
+        self.assertEqual(
+            self.extent(self.videos[0].pk),
+            (min(mx0, lx0), max(mx1, lx1), min(my0, ly0), max(my1, ly1)))
+        for video in self.videos[1:3]:
+            self.assertEqual(self.extent(video.pk), (mx0, mx1, my0, my1))
+        # not linked
+        self.assertEqual(self.extent(self.videos[3].pk),
+                         self.extent_before[self.videos[3].pk])
+
+    def test_map_changed(self):
+        self.extent_before = dict(
+            (video.pk, self.extent(video.pk)) for video in self.videos)
+        # the linked video ids are read once, then cached
+        update_video_extent(self.map)
+        if connection.vendor == 'postgresql':
+            # savepoint, extents, last_modified, release, whatever the
+            # number of videos
+            with self.assertNumQueries(4):
+                update_video_extent(self.map)
+        self.assert_extents()
+
+    def test_fallback(self):
+        self.extent_before = dict(
+            (video.pk, self.extent(video.pk)) for video in self.videos)
+        # the ORM path used on other databases
+        connection.vendor = 'sqlite'
+        try:
+            update_video_extents([video.pk for video in self.videos[:3]])
+        finally:
+            del connection.vendor
+        self.assert_extents()
+
+
+class RelatedResourcesTest(TestCase):
+
+    """
+    The resources linked to a video are read with one query per content
+    type and memoised until a link changes.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(60)
+        cls.video = Video.objects.order_by('id')[0]
+        cls.layers = list(Layer.objects.order_by('id')[:3])
+        cls.map = Map.objects.order_by('id')[0]
+        layer_ct = ContentType.objects.get_for_model(Layer)
+        VideoResourceLink.objects.bulk_create(
+            [VideoResourceLink(video=cls.video, content_type=layer_ct,
+                               object_id=layer.pk)
+             for layer in cls.layers[:2]] +
+            [VideoResourceLink(
+                video=cls.video, object_id=cls.map.pk,
+                content_type=ContentType.objects.get_for_model(Map))])
+
+    def test_queries_and_memo(self):
+        video = Video.objects.get(pk=self.video.pk)
+        # the links, then the layers and the maps
+        with self.assertNumQueries(3):
+            resources = get_related_resources(video)
+        self.assertEqual([resource.pk for resource in resources],
+                         [self.layers[0].pk, self.layers[1].pk, self.map.pk])
+        with self.assertNumQueries(0):
+            get_related_resources(video)
+
+        VideoResourceLink.objects.create(
+            video=self.video, object_id=self.layers[2].pk,
+            content_type=ContentType.objects.get_for_model(Layer))
+        with self.assertNumQueries(3):
+            resources = get_related_resources(video)
+        self.assertEqual(resources[-1].pk, self.layers[2].pk)
+
+
+class LinkChoicesTest(TestCase):
+
+    """
+    Videos can only be linked to the layers, maps and documents the user
+    can see, and the link choices list no other title.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('linker')
+        seed_resources(60)
+        cls.visible, cls.public, cls.private = Layer.objects.order_by('id')[:3]
+        assign_perm('view_resourcebase', cls.user,
+                    cls.visible.get_self_resource())
+        assign_perm('view_resourcebase', get_anonymous_user(),
+                    cls.public.get_self_resource())
+        cls.video = Video.objects.order_by('id')[0]
+
+    def value(self, resource):
+        return 'type:%s-id:%s' % (resource.polymorphic_ctype_id, resource.pk)
+
+    def field(self, linked=()):
+        field = LinkChoicesField(required=False)
+        field.user = self.user
+        field.linked = set(linked)
+        return field
+
+    def test_validation(self):
+        values = [self.value(self.visible), self.value(self.public)]
+        self.assertEqual(self.field().clean(','.join(values)), values)
+        self.assertEqual(self.field().clean(''), [])
+
+        for value in (self.value(self.private),
+                      # not a link value, a video, a missing layer
+                      'layer:%s' % self.visible.pk,
+                      self.value(self.video),
+                      'type:%s-id:0' % self.visible.polymorphic_ctype_id):
+            with self.assertRaises(ValidationError):
+                self.field().clean(','.join(values + [value]))
+
+        # a link to a resource the user cannot see is kept
+        private = self.value(self.private)
+        self.assertEqual(self.field(linked=[private]).clean(private),
+                         [private])
+
+    def test_search_choices(self):
+        choices, more = search_link_choices(self.user, page_size=100)
+        self.assertFalse(more)
+        self.assertEqual(
+            set(value for value, _ in choices),
+            set([self.value(self.visible), self.value(self.public)]))
+        choices, _ = search_link_choices(
+            self.user, query=self.private.title, page_size=100)
+        self.assertNotIn(self.value(self.private),
+                         [value for value, _ in choices])
+
+
+class LinksForm(VideoFormMixin):
+
+    # the parts of a validated video form save_many2many reads
+    def __init__(self, instance, links):
+        self.instance = instance
+        self.cleaned_data = {'links': links}
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class SaveLinksTest(TestCase):
+
+    """
+    ``save_many2many`` makes the links of a video match the submitted
+    values with the same queries however many links change.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_resources(150)
+        cls.video = Video.objects.order_by('id')[0]
+        cls.layers = list(Layer.objects.order_by('id')[:12])
+
+    def setUp(self):
+        cache.clear()
+
+    def value(self, resource):
+        return 'type:%s-id:%s' % (resource.polymorphic_ctype_id, resource.pk)
+
+    def links(self):
+        return list(VideoResourceLink.objects.filter(
+            video=self.video).order_by('id').values_list('id', 'object_id'))
+
+    def save(self, resources, extra=()):
+        form = LinksForm(self.video, [self.value(resource)
+                                      for resource in resources] + list(extra))
+        with CaptureQueriesContext(connection) as queries:
+            form.save_many2many()
+        return len(queries)
+
+    def test_reconcile(self):
+        self.save(self.layers[:2])
+        kept = self.links()[1]
+        related_video_ids(self.layers[:3])
+        # a duplicate and a malformed value are ignored
+        self.save(self.layers[1:3],
+                  extra=[self.value(self.layers[2]), 'layer:1'])
+        links = self.links()
+        self.assertEqual([object_id for _, object_id in links],
+                         [self.layers[1].pk, self.layers[2].pk])
+        self.assertEqual(links[0], kept)
+
+        # the cached ids of the resources whose links changed were dropped
+        related = related_video_ids(self.layers[:3])
+        self.assertEqual(related[self.layers[0].pk], [])
+        self.assertEqual(related[self.layers[2].pk], [self.video.pk])
+
+    def test_queries(self):
+        self.save(self.layers[:2])
+        few = self.save(self.layers[1:3])
+        self.save(self.layers[:6])
+        many = self.save(self.layers[6:12])
+        self.assertEqual(few, many)
+        # nothing to create or delete
+        self.assertLess(self.save(self.layers[6:12]), few)
+
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class FavoritesTest(TestCase):
+
+    """
+    The cached favorites of a user are dropped when a favorited resource is
+    deleted, so neither ``bulk_favorite_objects`` nor the favorites page
+    lists it.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('fan')
+        seed_resources(30)
+        cls.video = Video.objects.order_by('id')[0]
+        cls.document = Document.objects.order_by('id')[0]
+        ResourceBase.objects.filter(pk=cls.video.pk).update(
+            title='Favorite video')
+        ResourceBase.objects.filter(pk=cls.document.pk).update(
+            title='Favorite document')
+
+    def setUp(self):
+        cache.clear()
+
+    def favorite_ids(self):
+        return set(
+            obj.pk for objects in
+            ModFavorite.objects.bulk_favorite_objects(self.user).values()
+            for obj in objects)
+
+    def test_deleted_resource(self):
+        for resource in (self.video, self.document):
+            ModFavorite.objects.create_favorite(resource, self.user)
+        self.assertEqual(self.favorite_ids(),
+                         set([self.video.pk, self.document.pk]))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('favorite_list'))
+        self.assertContains(response, 'Favorite video')
+        self.assertContains(response, 'Favorite document')
+
+        Video.objects.get(pk=self.video.pk).delete()
+        # the favorite is kept, but its cached object is gone
+        self.assertTrue(Favorite.objects.filter(
+            user=self.user, object_id=self.video.pk).exists())
+        self.assertEqual(self.favorite_ids(), set([self.document.pk]))
+        response = self.client.get(reverse('favorite_list'))
+        self.assertNotContains(response, 'Favorite video')
+        self.assertContains(response, 'Favorite document')
+
+
+class FavoriteStatesTest(TestCase):
+
+    """
+    ``favorite_states`` returns the favorite info of at most
+    ``FAVORITE_STATES_MAX`` resources, ignoring malformed entries.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('fan')
+        seed_resources(30)
+        cls.video = Video.objects.order_by('id')[0]
+        cls.favorite = ModFavorite.objects.create_favorite(cls.video, cls.user)
+
+    def states(self, *resources):
+        response = self.client.get(
+            reverse('favorite_states'), {'resources': ','.join(resources)})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_cap(self):
+        states = self.states(*['video:%s' % pk for pk in range(1, 251)])
+        self.assertEqual(
+            set(states),
+            set('video:%s' % pk for pk in range(1, FAVORITE_STATES_MAX + 1)))
+
+    def test_malformed(self):
+        states = self.states('video', 'video:', 'video:x', ':5', 'video:-1',
+                             'widget:3', 'video:1.5', 'layer:4')
+        self.assertEqual(set(states), set(['layer:4']))
+        self.assertEqual(self.states(), {})
+
+    def test_states(self):
+        key = 'video:%s' % self.video.pk
+        # anonymous users have no favorites, but get the add URLs
+        self.assertEqual(self.states(key, 'layer:4'), {
+            key: {'add_url': reverse('add_favorite_video',
+                                     args=[self.video.pk]),
+                  'has_favorite': 'false'},
+            'layer:4': {'add_url': reverse('add_favorite_layer', args=[4]),
+                        'has_favorite': 'false'},
+        })
+
+        self.client.force_login(self.user)
+        states = self.states(key, 'layer:4')
+        self.assertEqual(states[key]['has_favorite'], 'true')
+        self.assertEqual(states[key]['delete_url'],
+                         reverse('delete_favorite', args=[self.favorite.pk]))
+        self.assertEqual(states['layer:4']['has_favorite'], 'false')
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class RelatedVideosTest(TestCase):
+
+    """
+    Layer and map pages list the linked videos the user can see, from ids
+    cached until a link of the resource is saved or deleted.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('viewer')
+        seed_resources(60)
+        cls.videos = list(Video.objects.order_by('id'))
+        cls.layers = list(Layer.objects.order_by('id')[:2])
+        layer_ct = ContentType.objects.get_for_model(Layer)
+        VideoResourceLink.objects.bulk_create([
+            VideoResourceLink(video=video, content_type=layer_ct,
+                              object_id=layer.pk)
+            for video, layer in ((cls.videos[0], cls.layers[0]),
+                                 (cls.videos[1], cls.layers[0]),
+                                 (cls.videos[2], cls.layers[1]))])
+        for video in (cls.videos[0], cls.videos[2]):
+            assign_perm('view_resourcebase', cls.user,
+                        video.get_self_resource())
+
+    def setUp(self):
+        cache.clear()
+
+    def test_visibility(self):
+        layer = self.layers[0]
+        self.assertEqual(
+            set(video.pk for video in get_related_videos(layer)),
+            set([self.videos[0].pk, self.videos[1].pk]))
+        self.assertEqual(
+            [video.pk for video in get_related_videos(layer, self.user)],
+            [self.videos[0].pk])
+        self.assertFalse(get_related_videos(layer, AnonymousUser()).exists())
+
+        related = get_related_videos_bulk(self.layers, self.user)
+        self.assertEqual(
+            dict((pk, [video.pk for video in videos])
+                 for pk, videos in related.items()),
+            {self.layers[0].pk: [self.videos[0].pk],
+             self.layers[1].pk: [self.videos[2].pk]})
+
+        request = RequestFactory().get('/')
+        request.user = self.user
+        self.assertEqual(related_videos({'request': request}, layer),
+                         [self.videos[0]])
+
+    def test_links_clear_ids(self):
+        layer = self.layers[1]
+        self.assertEqual(related_video_ids([layer]),
+                         {layer.pk: [self.videos[2].pk]})
+        with self.assertNumQueries(0):
+            related_video_ids([layer])
+
+        link = VideoResourceLink.objects.create(
+            video=self.videos[1], object_id=layer.pk,
+            content_type=ContentType.objects.get_for_model(Layer))
+        self.assertEqual(related_video_ids([layer]),
+                         {layer.pk: [self.videos[2].pk, self.videos[1].pk]})
+
+        link.delete()
+        self.assertEqual(related_video_ids([layer]),
+                         {layer.pk: [self.videos[2].pk]})
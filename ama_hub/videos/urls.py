@@ -32,6 +32,10 @@ urlpatterns = [  # 'ama_videos.videos.views',
         VideoUploadView.as_view()), name='video_upload'),
     url(r'^search/?$', views.video_search_page,
         name='video_search_page'),
+    url(r'^autocomplete/?$', views.video_autocomplete,
+        name='video_autocomplete'),
+    url(r'^link_choices/?$', views.video_link_choices,
+        name='video_link_choices'),
     url(r'^(?P<vidid>[^/]*)/metadata_detail$', views.video_metadata_detail,
         name='video_metadata_detail'),
     url(r'^(?P<vidid>\d+)/metadata$',
@@ -3,6 +3,7 @@
 import os
 import json
 import logging
+from functools import partial
 from itertools import chain
 
 from guardian.shortcuts import get_perms
@@ -13,13 +14,13 @@ from django.template import loader
 from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.core.exceptions import PermissionDenied
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from django_downloadview.response import DownloadResponse
 from django.views.generic.edit import UpdateView, CreateView
-from django.db.models import F
 from django.forms.utils import ErrorList
 
 from geonode.utils import resolve_object
@@ -27,10 +28,14 @@ from geonode.security.views import _perms_info_json
 from geonode.people.forms import ProfileForm
 from geonode.base.forms import CategoryForm
 from geonode.base.models import TopicCategory
+from ama_hub.api_cache import tag_versions
 from ama_hub.videos.models import Video, get_related_resources
 from ama_hub.videos.forms import VideoForm, VideoCreateForm, VideoReplaceForm
+from ama_hub.videos.forms import search_link_choices
 from ama_hub.videos.models import IMGTYPES
 from ama_hub.videos.renderers import generate_thumbnail_content, MissingPILError
+from ama_hub.videos.popularity import record_hit
+from ama_hub.videos.suggest import suggest
 from geonode.utils import build_social_links
 from geonode.groups.models import GroupProfile
 from geonode.base.views import batch_modify
@@ -40,6 +45,9 @@ logger = logging.getLogger("ama_hub.videos.views")
 
 ALLOWED_DOC_TYPES = settings.ALLOWED_DOCUMENT_TYPES
 
+# seconds the user independent fragments of the detail page are cached
+VIDEO_DETAIL_CACHE_TIMEOUT = getattr(settings, 'VIDEO_DETAIL_CACHE_TIMEOUT', 600)
+
 _PERMISSION_MSG_DELETE = _("You are not permitted to delete this video")
 _PERMISSION_MSG_GENERIC = _("You do not have permissions for this video.")
 _PERMISSION_MSG_MODIFY = _("You are not permitted to modify this video")
@@ -49,12 +57,31 @@ _PERMISSION_MSG_VIEW = _("You are not permitted to view this video")
 
 
 def _resolve_video(request, vidid, permission='base.change_resourcebase',
-                      msg=_PERMISSION_MSG_GENERIC, **kwargs):
+                      msg=_PERMISSION_MSG_GENERIC, queryset=None, **kwargs):
     '''
     Resolve the video by the provided primary key and check the optional permission.
     '''
-    return resolve_object(request, Video, {'pk': vidid},
-                          permission=permission, permission_msg=msg, **kwargs)
+    return resolve_object(request, Video if queryset is None else queryset,
+                          {'pk': vidid}, permission=permission,
+                          permission_msg=msg, **kwargs)
+
+
+def _related_cache_key(video):
+    """
+    Returns the part of the related resources fragment key that changes
+    with the links of ``video`` and with the linked resources: the linked
+    ids, read from the prefetched links, and the versions of the API cache
+    tags their saves bump.
+    """
+    links = sorted((link.id, link.content_type_id, link.object_id)
+                   for link in video.links.all())
+    resource_types = sorted(set(
+        ContentType.objects.get_for_id(content_type_id).model
+        for _, content_type_id, _ in links))
+    return '%s|%s' % (
+        ','.join('%s-%s' % (content_type_id, object_id)
+                 for _, content_type_id, object_id in links),
+        ':'.join(str(v) for v in tag_versions(resource_types)))
 
 
 def video_detail(request, vidid):
@@ -67,7 +94,10 @@ def video_detail(request, vidid):
             request,
             vidid,
             'base.view_resourcebase',
-            _PERMISSION_MSG_VIEW)
+            _PERMISSION_MSG_VIEW,
+            queryset=Video.objects.select_related(
+                'resourcebase_ptr', 'owner', 'category', 'group',
+                'license').prefetch_related('links'))
 
     except Http404:
         return HttpResponse(
@@ -89,34 +119,35 @@ def video_detail(request, vidid):
         )
 
     else:
-        related = get_related_resources(video)
-
         # Update count for popularity ranking,
         # but do not includes admins or resource owners
         if request.user != video.owner and not request.user.is_superuser:
-            Video.objects.filter(
-                id=video.id).update(
-                popular_count=F('popular_count') + 1)
-
-        metadata = video.link_set.metadata().filter(
-            name__in=settings.DOWNLOAD_FORMATS_METADATA)
+            record_hit(video.id)
 
         group = None
-        if video.group:
-            try:
-                group = GroupProfile.objects.get(slug=video.group.name)
-            except GroupProfile.DoesNotExist:
-                group = None
+        if video.group_id:
+            group = GroupProfile.objects.filter(group_id=video.group_id).first()
+
+        # permissions are granted on the ResourceBase, see set_permissions;
+        # nothing assigns object permissions on the Video itself, and the
+        # template only tests the *_resourcebase codenames, so its own
+        # permissions are not read
+        perms_list = get_perms(request.user, video.get_self_resource())
+
+        # related resources and metadata links are only read when the
+        # fragments showing them are not cached
         context_dict = {
-            'perms_list': get_perms(
-                request.user,
-                video.get_self_resource()) + get_perms(request.user, video),
-            'permissions_json': _perms_info_json(video),
+            'perms_list': perms_list,
+            'permissions_json': _perms_info_json(video)
+            if 'change_resourcebase_permissions' in perms_list else None,
             'resource': video,
             'group': group,
-            'metadata': metadata,
+            'metadata': video.link_set.metadata().filter(
+                name__in=settings.DOWNLOAD_FORMATS_METADATA),
             'imgtypes': IMGTYPES,
-            'related': related}
+            'related': partial(get_related_resources, video),
+            'related_cache_key': _related_cache_key(video),
+            'fragment_cache_timeout': VIDEO_DETAIL_CACHE_TIMEOUT}
 
         if settings.SOCIAL_ORIGINS:
             context_dict["social_links"] = build_social_links(
@@ -168,6 +199,11 @@ class VideoUploadView(CreateView):
         context['ALLOWED_DOC_TYPES'] = ALLOWED_DOC_TYPES
         return context
 
+    def get_form_kwargs(self):
+        kwargs = super(VideoUploadView, self).get_form_kwargs()
+        kwargs['user'] = self.request.user
+        return kwargs
+
     def form_invalid(self, form):
         if self.request.GET.get('no__redirect', False):
             out = {'success': False}
@@ -344,12 +380,14 @@ def video_metadata(
             video_form = VideoForm(
                 request.POST,
                 instance=video,
-                prefix="resource")
+                prefix="resource",
+                user=request.user)
             category_form = CategoryForm(request.POST, prefix="category_choice_field", initial=int(
                 request.POST["category_choice_field"]) if "category_choice_field" in request.POST and
                 request.POST["category_choice_field"] else None)
         else:
-            video_form = VideoForm(instance=video, prefix="resource")
+            video_form = VideoForm(
+                instance=video, prefix="resource", user=request.user)
             category_form = CategoryForm(
                 prefix="category_choice_field",
                 initial=topic_category.id if topic_category else None)
@@ -593,6 +631,43 @@ def video_search_page(request):
         context={'init_search': json.dumps(params or {}), "site": settings.SITEURL})
 
 
+def video_autocomplete(request):
+    """
+    Returns the ids and titles of the public videos matching the ``q``
+    prefix, for search-as-you-type.
+    """
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 50)
+    except ValueError:
+        limit = 10
+    results = [
+        {'id': pk, 'title': title}
+        for pk, title in suggest(request.GET.get('q', ''), limit=limit)]
+    return HttpResponse(
+        json.dumps({'results': results}),
+        content_type='application/json')
+
+
+@login_required
+def video_link_choices(request):
+    """
+    Returns a page of the resources a video can be linked to, for the
+    select2 widget of the ``links`` field.
+    """
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    choices, more = search_link_choices(
+        request.user, request.GET.get('q', ''), page=page)
+    return HttpResponse(
+        json.dumps({
+            'results': [{'id': value, 'text': label} for value, label in choices],
+            'more': more,
+        }),
+        content_type='application/json')
+
+
 @login_required
 def video_remove(request, vidid, template='videos/video_remove.html'):
     try:
@@ -36,4 +36,55 @@ def favorite(req, subject, id):
     delete_url = reverse("delete_favorite", args=[favorite.pk])
     response = {"has_favorite": "true", "delete_url": delete_url}
 
-    return HttpResponse(json.dumps(response), content_type="application/json", status=200)
\ No newline at end of file
+    return HttpResponse(json.dumps(response), content_type="application/json", status=200)
+
+# most resources whose favorite state is returned by one request
+FAVORITE_STATES_MAX = 200
+
+
+def favorite_states(req):
+    """
+    Returns the favorite info of a page of resources for the current user,
+    keyed by ``<type>:<id>``. The resources are passed as
+    ``?resources=video:1,layer:2``; malformed entries are ignored.
+    """
+    resources = []
+    for value in req.GET.get('resources', '').split(',')[:FAVORITE_STATES_MAX]:
+        subject, _, pk = value.partition(':')
+        if pk.isdigit():
+            resources.append((subject, int(pk)))
+
+    states = ModFavorite.objects.favorite_info_for_user(req.user, resources)
+    response = dict(
+        ('%s:%s' % key, info) for key, info in states.items())
+
+    return HttpResponse(json.dumps(response), content_type="application/json", status=200)
+
+
+class FavoriteRow(object):
+
+    """
+    A row of the favorites page, with the attributes of a Favorite that
+    favorite/favorite_list.html reads.
+    """
+
+    def __init__(self, content_type, content_object):
+        self.pk = content_object.favorite_id
+        self.content_type = content_type
+        self.content_object = content_object
+
+
+@login_required
+def favorite_list(req):
+    """
+    Lists the favorites of the current user, most recent first, from the
+    cached objects of ``bulk_favorite_objects`` instead of one query per
+    favorite.
+    """
+    favorites = [
+        FavoriteRow(content_type, obj) for content_type, objects in
+        ModFavorite.objects.bulk_favorite_objects(req.user).items()
+        for obj in objects]
+    favorites.sort(key=lambda row: row.pk, reverse=True)
+
+    return render(req, "favorite/favorite_list.html", context={"favorites": favorites})
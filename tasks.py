@@ -83,12 +83,16 @@ def migrations(ctx):
     ctx.run("python manage.py updategeoip --settings={0}".format(
         _localsettings()
     ), pty=True)
-    try:
-        ctx.run("python manage.py rebuild_index --noinput --settings={0}".format(
-            _localsettings()
-        ), pty=True)
-    except:
-        pass
+    # incremental: only resources changed since the last completed run, and
+    # resuming an interrupted one; indexes whose version changed, as when
+    # their documents gained the permission principals, and indexes without
+    # an updated field are indexed in full
+    result = ctx.run("python manage.py reindex_resources --since last --settings={0}".format(
+        _localsettings()
+    ), pty=True, warn=True)
+    if result.failed:
+        print "Reindexing failed (exit code {0}); run reindex_resources again to resume".format(
+            result.exited)
 
 @task
 def statics(ctx):